@@ -0,0 +1,118 @@
+# Copyright (C) 2020-2022 Coturex - F5RQG
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Allocation engine of the regulation loop.
+# It computes the target power of every equipment in one pass over the priority ordered arrays, without any side
+# effect: the regulation sends the commands once the plan is final (only for the equipments whose power changes).
+# The rules are the ones of the equipment classes:
+# - excess consumption is cancelled starting from the lowest priority equipment. A variable equipment is decreased,
+#   and turned off if it would go below its minimal power. A constant equipment is turned off.
+# - surplus power is allocated starting from the highest priority equipment. A variable equipment is increased up to
+#   its maximal power, if it reaches its minimal power. A constant equipment is turned on if the surplus covers it.
+# - forced and overed equipments are left as they are.
+# With the knapsack selection, the constant equipments that are off are not examined one by one: when the first one
+# is reached, the subset of them which best fits the surplus is turned on (see select_constant), and the variable
+# equipments of lower priority fill the remainder.
+
+import math
+
+# Bounds of the knapsack selector: the surplus is split in at most MAX_CELLS quanta, at most MAX_ITEMS loads are examined
+MAX_CELLS = 16384
+MAX_ITEMS = 32
+
+
+def select_constant(available, weights):
+    """ Return the indexes of the weights (priority order) whose sum is the closest to available, without exceeding it.
+    Among the best subsets, the one with the highest priority loads is selected (lexicographic order).
+    The runtime is bounded by MAX_ITEMS * MAX_CELLS bit operations: the powers are counted in quanta of their gcd, and
+    the quantum is enlarged when the surplus is still above MAX_CELLS quanta, the weights being rounded up so that the
+    selection never exceeds the surplus."""
+    available = int(available)
+    if available <= 0 or not weights:
+        return []
+    weights = weights[:MAX_ITEMS]
+    n = len(weights)
+    step = math.gcd(*(int(w) for w in weights)) or 1
+    if available // step > MAX_CELLS:
+        step = -(-available // MAX_CELLS)
+    capacity = available // step
+    quanta = [-(-int(w) // step) for w in weights]
+    full = (1 << (capacity + 1)) - 1
+    # reach[k] : bitset of the sums reachable with the loads k..n-1
+    reach = [0] * (n + 1)
+    reach[n] = 1
+    for k in range(n - 1, -1, -1):
+        reach[k] = (reach[k + 1] | (reach[k + 1] << quanta[k])) & full
+    left = reach[0].bit_length() - 1
+    selection = []
+    for k in range(n):
+        q = quanta[k]
+        if q <= left and (reach[k + 1] >> (left - q)) & 1:
+            selection.append(k)
+            left -= q
+    return selection
+
+
+def plan(power_delta, min_power, max_power, current, forced, overed, constant, knapsack=False):
+    """ Return the list of target powers (W)
+    power_delta: surplus to allocate when > 0, excess consumption to cancel when < 0
+    min_power, max_power, current: powers of the equipments (priority order)
+    forced, overed, constant: masks of the equipments (constant: on/off equipment of max_power)
+    knapsack: select the constant equipments to turn on with select_constant instead of one by one"""
+    targets = list(current)
+    n = len(targets)
+    if power_delta < 0:
+        excess = -power_delta
+        for i in range(n - 1, -1, -1):
+            if excess <= 0:
+                break
+            if forced[i] or overed[i]:
+                continue
+            p = current[i]
+            if constant[i]:
+                if p != 0:
+                    targets[i] = 0
+                    excess -= max_power[i]
+            elif p > 0:
+                decrease = excess if excess < p else p
+                if p - decrease < min_power[i]:
+                    decrease = p
+                targets[i] = p - decrease
+                excess -= decrease
+    elif power_delta > 0:
+        available = power_delta
+        selected = False
+        for i in range(n):
+            if available <= 0:
+                break
+            if forced[i] or overed[i]:
+                continue
+            p = current[i]
+            if constant[i] and knapsack:
+                if not selected:
+                    selected = True
+                    candidates = [k for k in range(i, n)
+                                  if constant[k] and current[k] == 0 and not forced[k] and not overed[k]]
+                    for k in select_constant(available, [max_power[k] for k in candidates]):
+                        targets[candidates[k]] = max_power[candidates[k]]
+                        available -= max_power[candidates[k]]
+            elif constant[i]:
+                if p == 0 and available >= max_power[i]:
+                    targets[i] = max_power[i]
+                    available -= max_power[i]
+            else:
+                increase = max_power[i] - p if p + available >= max_power[i] else available
+                if increase > 0 and p + increase >= min_power[i]:
+                    targets[i] = p + increase
+                    available -= increase
+    return targets
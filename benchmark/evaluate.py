@@ -0,0 +1,249 @@
+#!/usr/bin/python3
+
+# Copyright (C) 2020-2022 Coturex - F5RQG
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Micro-benchmark of the regulation hot path, for 1, 10, 100 and 1000 synthetic equipments (the water heater, then
+# variable and constant equipments in turn, their calibration files are links to the calibration of the repository
+# in a temporary directory). The MQTT client only counts
+# the publications. Per call latency (median, p95) and transient memory (tracemalloc peak) of:
+# - evaluate() in each branch : surplus (equipments off), deficit (equipments on), balanced, and recovery (PZEM
+#   timeout, every equipment is reset to 0)
+# - power_to_percent, build_status and json.dumps of the status
+# - evaluate() in the deficit branch with the debug and log files enabled (temporary directory), written by the
+#   calling thread ('log_sync') or queued to the writer thread of debug_log ('log_queue')
+# The results are stored in benchmark/results/evaluate-<date>.json (local to the machine, not versioned) and compared
+# with the previous result.
+#
+# $> python3 benchmark/evaluate.py [-d config_dir] [--sizes 1,10,100,1000] [--no-save]
+
+import argparse, datetime, glob, json, os, platform, statistics, subprocess, sys, tempfile, time, tracemalloc, logging
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS = os.path.join(REPO, 'benchmark', 'results')
+sys.path.insert(0, REPO)
+
+MIN_TIME = 0.3      # seconds spent per measure
+MIN_CALLS = 20
+MAX_CALLS = 5000
+MEMORY_CALLS = 10
+
+
+class NullClient:
+    def __init__(self):
+        self.published = 0
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.published += 1
+
+    def subscribe(self, topic, qos=0):
+        pass
+
+
+_calibrations = None    # temporary directory of the calibration files of the synthetic variators
+
+def calibration_dir():
+    global _calibrations
+    if _calibrations is None:
+        _calibrations = tempfile.TemporaryDirectory()
+    return _calibrations.name
+
+def build(regulation, equipment, n):
+    """ Replace the equipments of the configuration by n synthetic ones"""
+    config = regulation.config
+    calibration = os.path.join(REPO, 'power_calibration_ecs.csv')
+    directory = calibration_dir()
+    config.remove_section('equipments')
+    config.add_section('equipments')
+    for i in range(n):
+        name = 'bench{}'.format(i)
+        if i % 2 == 0:
+            config['equipments'][name] = 'water_heater' if i == 0 else 'variable'
+            config[name] = {'min_power': '101', 'min_percent': '4', 'topic_set_power': 'bench/' + name}
+            link = os.path.join(directory, 'power_calibration_' + name + '.csv')
+            if not os.path.exists(link):
+                os.symlink(calibration, link)
+        else:
+            config['equipments'][name] = 'constant'
+            config[name] = {'max_power': str(300 + 100 * (i % 15)), 'topic_set_power': 'bench/' + name,
+                            'json_on': '{"cmd": "on"}', 'json_off': '{"cmd": "off"}'}
+    client = NullClient()
+    regulation.mqtt_client = client
+    equipment.setup(client, False, '')
+    cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        regulation.init_equipments()
+    finally:
+        os.chdir(cwd)
+    return client
+
+def set_state(regulation, on, cons, prod, age=0):
+    """ Equipments all on (max power) or all off, measurements cons/prod received age seconds ago"""
+    for e in regulation.equipments:
+        e.current_power = e.MAX_POWER if on else 0
+        e.last_command = None
+        if e.type == "constant":
+            e.is_on = on
+    now = regulation.now_ts()
+    regulation.power_consumption = cons
+    regulation.power_production = prod
+    regulation.last_consumption_date = now - age
+    regulation.last_production_date = now - age
+    regulation.last_evaluation_date = None
+
+def scenarios(regulation):
+    total = sum(regulation.equipments_max_power)
+    margin, threshold = regulation.MARGIN, regulation.BALANCE_THRESHOLD
+    return {
+        'surplus': (False, 300, 300 + margin + total // 2),
+        'deficit': (True, 300 + total, 300 + total // 2),
+        'balanced': (True, 300, 300 + margin + threshold // 2),
+        'recovery': (True, 300, 300 + total // 2, regulation.PZEM_TIMEOUT + 10),
+    }
+
+def measure(call, setup=None):
+    """ Return the per call latencies (s) of call(), setup() runs before each call and is not measured"""
+    times = []
+    spent = 0
+    while len(times) < MAX_CALLS and (len(times) < MIN_CALLS or spent < MIN_TIME):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        call()
+        dt = time.perf_counter() - start
+        times.append(dt)
+        spent += dt
+    return times
+
+def memory(call, setup=None):
+    """ Return the max transient memory (bytes) allocated by call()"""
+    peak = 0
+    tracemalloc.start()
+    for i in range(MEMORY_CALLS):
+        if setup is not None:
+            setup()
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        call()
+        peak = max(peak, tracemalloc.get_traced_memory()[1] - base)
+    tracemalloc.stop()
+    return peak
+
+def summary(times, peak):
+    times = sorted(times)
+    return {
+        'calls': len(times),
+        'median_us': round(statistics.median(times) * 1e6, 2),
+        'p95_us': round(times[int(len(times) * 0.95) - 1] * 1e6, 2),
+        'peak_bytes': peak,
+    }
+
+def logged(call, setup, queued):
+    """ Latencies and memory of call() with the debug and log files enabled"""
+    import debug_log
+    loggers = (debug_log.debugger, debug_log.logger)
+    with tempfile.TemporaryDirectory() as d:
+        debug_log.configure(os.path.join(d, 'debug.log'), os.path.join(d, 'pv.log'), queued)
+        disabled = [l.disabled for l in loggers]
+        for l in loggers:
+            l.disabled = False
+        try:
+            return summary(measure(call, setup), memory(call, setup))
+        finally:
+            debug_log.configure(None, None)
+            for l, off in zip(loggers, disabled):
+                l.disabled = off
+
+def run(sizes):
+    import regulation, equipment
+    regulation.EVALUATE_ON_MESSAGE = True
+    regulation.EVALUATE_CLOCK_JOBS = False
+    results = {}
+    for n in sizes:
+        build(regulation, equipment, n)
+        results[n] = r = {}
+        for name, state in scenarios(regulation).items():
+            setup = lambda: set_state(regulation, *state)
+            r['evaluate_' + name] = summary(measure(regulation.evaluate, setup), memory(regulation.evaluate, setup))
+        setup = lambda: set_state(regulation, *scenarios(regulation)['deficit'])
+        r['evaluate_log_sync'] = logged(regulation.evaluate, setup, False)
+        r['evaluate_log_queue'] = logged(regulation.evaluate, setup, True)
+        heater = regulation.equipment_water_heater
+        watts = iter(range(10 ** 9))
+        p2p = lambda: heater.power_to_percent(next(watts) % heater.MAX_POWER)
+        r['power_to_percent'] = summary(measure(p2p), memory(p2p))
+        set_state(regulation, True, 300, 1500)
+        status = lambda: regulation.build_status(regulation.now_ts(), 300, 1500, 0, 0)
+        r['build_status'] = summary(measure(status), memory(status))
+        msg = status()
+        dumps = lambda: json.dumps(msg)
+        r['json_dumps'] = summary(measure(dumps), memory(dumps))
+        print("{} equipments".format(n), file=sys.stderr)
+    return results
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO, capture_output=True,
+                              text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+def print_results(results, previous=None):
+    print("{:>6} {:20} {:>10} {:>10} {:>11} {:>8}".format('equip.', 'measure', 'median us', 'p95 us', 'peak bytes',
+                                                          'vs prev'))
+    for n, r in results.items():
+        for name, s in r.items():
+            change = ''
+            if previous is not None:
+                p = previous.get(str(n), {}).get(name)
+                if p and p['median_us']:
+                    change = "{:+.0f}%".format(100 * (s['median_us'] / p['median_us'] - 1))
+            print("{:>6} {:20} {:10.2f} {:10.2f} {:11} {:>8}".format(n, name, s['median_us'], s['p95_us'],
+                                                                   s['peak_bytes'], change))
+
+def main():
+    parser = argparse.ArgumentParser(description="micro-benchmark of evaluate() and of its hot path")
+    parser.add_argument('-d', '--directory', default='.', help="directory of config.ini")
+    parser.add_argument('--sizes', default='1,10,100,1000', help="numbers of equipments, comma separated")
+    parser.add_argument('--no-save', action='store_true', help="do not store the results")
+    args = parser.parse_args()
+
+    os.chdir(args.directory)
+    logging.getLogger('regulation_log').disabled = True
+    logging.getLogger('regulation_debug').disabled = True
+    results = run([int(n) for n in args.sizes.split(',')])
+
+    previous = None
+    files = sorted(glob.glob(os.path.join(RESULTS, 'evaluate-*.json')))
+    if files:
+        with open(files[-1]) as f:
+            previous = json.load(f)['results']
+    print_results(results, previous)
+    if not args.no_save:
+        os.makedirs(RESULTS, exist_ok=True)
+        date = datetime.datetime.now()
+        path = os.path.join(RESULTS, 'evaluate-' + date.strftime('%Y%m%d-%H%M%S') + '.json')
+        with open(path, 'w') as f:
+            json.dump({
+                'date': date.isoformat(timespec='seconds'),
+                'commit': git_commit(),
+                'python': platform.python_version(),
+                'machine': platform.machine(),
+                'node': platform.node(),
+                'results': results,
+            }, f, indent=1)
+        print("saved " + os.path.relpath(path, REPO))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+#!/usr/bin/python3
+
+# Copyright (C) 2020-2022 Coturex - F5RQG
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Startup benchmark of the regulation: time from the process start to the end of the first evaluation.
+# Each run is a fresh python process started in a temporary copy of the configuration directory (config.ini with
+# debug_file and log_file set to none, calibration files, status.ini and its journal) : the logs and status files of
+# a daemon running in this directory are not touched. The phases are the ones of regulation.main():
+# - import   : regulation module (config, logs, weather, equipment classes)
+# - init     : MQTT client, equipments (calibration), status
+# - evaluate : first consumption and production messages, then the first evaluation
+# - process  : wall time of the whole process, python startup and exit included
+# The broker is never contacted (the client is not connected, commands are dropped by paho), runs are repeatable.
+#
+# $> python3 benchmark/startup.py [-n runs] [-d config_dir]
+
+import argparse, configparser, glob, json, os, shutil, statistics, subprocess, sys, tempfile, time
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CHILD = """
+import time
+t0 = time.perf_counter()
+import sys, json, types
+sys.path.insert(0, {repo!r})
+import regulation, equipment
+t1 = time.perf_counter()
+import paho.mqtt.client as mqtt
+client = mqtt.Client()
+regulation.mqtt_client = client
+equipment.setup(client, regulation.SIMULATION, regulation.prefix)
+regulation.init_equipments()
+regulation.loadStatus() if (regulation.config['debug']['use_persistent'] in regulation.set_words) else ''
+t2 = time.perf_counter()
+regulation.EVALUATE_ON_MESSAGE = False
+for topic, power in ((regulation.TOPIC_SENSOR_CONSUMPTION, 300), (regulation.TOPIC_SENSOR_PRODUCTION, 1500)):
+    regulation.on_message(client, None, types.SimpleNamespace(topic=topic, payload=json.dumps({{'power': power}}).encode()))
+regulation.evaluate()
+t3 = time.perf_counter()
+print(json.dumps({{
+    'import': t1 - t0, 'init': t2 - t1, 'evaluate': t3 - t2,
+    'modules': [m for m in ('numpy', 'requests', 'psutil', 'paho') if m in sys.modules],
+}}))
+"""
+
+PHASES = ('import', 'init', 'evaluate', 'process')
+
+
+def prepare(directory, workdir):
+    """ Copy the configuration of directory in workdir, without the log files"""
+    config = configparser.ConfigParser(interpolation=None)
+    config.read(os.path.join(directory, 'config.ini'))
+    config['debug']['debug_file'] = 'none'
+    config['debug']['log_file'] = 'none'
+    for section in config.sections():
+        path = config[section].get('calibration_file')
+        if path is not None:
+            config[section]['calibration_file'] = os.path.join(os.path.abspath(directory), path)
+    with open(os.path.join(workdir, 'config.ini'), 'w') as f:
+        config.write(f)
+    for pattern in ('*.csv', '*.csv.cache', 'status.ini', 'status.ini.journal'):
+        for path in glob.glob(os.path.join(directory, pattern)):
+            shutil.copy2(path, workdir)
+
+def run_once(directory):
+    start = time.perf_counter()
+    out = subprocess.run([sys.executable, '-c', CHILD.format(repo=REPO)], cwd=directory, check=True,
+                         capture_output=True, text=True).stdout
+    result = json.loads(out.strip().splitlines()[-1])
+    result['process'] = time.perf_counter() - start
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description="time to first evaluation of the regulation")
+    parser.add_argument('-n', '--runs', type=int, default=10)
+    parser.add_argument('-d', '--directory', default='.', help="directory of config.ini and of the calibration files")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        prepare(args.directory, workdir)
+        run_once(workdir)  # warm-up: page cache, calibration cache
+        runs = [run_once(workdir) for i in range(args.runs)]
+    print("{} runs, python {}, modules loaded : {}".format(args.runs, sys.version.split()[0],
+                                                           ', '.join(runs[-1]['modules']) or 'none'))
+    print("{:10} {:>10} {:>10} {:>10}".format('phase (ms)', 'median', 'min', 'max'))
+    for phase in PHASES:
+        values = [r[phase] * 1000 for r in runs]
+        print("{:10} {:10.1f} {:10.1f} {:10.1f}".format(phase, statistics.median(values), min(values), max(values)))
+
+if __name__ == '__main__':
+    main()
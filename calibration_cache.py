@@ -0,0 +1,113 @@
+# Copyright (C) 2020-2022 Coturex - F5RQG
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Compiled calibration of the variable power equipments.
+# Fitting the calibration CSV (loadtxt, polyfit, 201 evaluations, inverse table) is slow on a Pi Zero, the result is
+# stored next to the CSV (power_calibration_<name>.csv.cache) and memory-mapped on the next starts. The artifact is
+# keyed by the sha256 of the CSV content and the polynomial degree: it is rebuilt when the calibration file changes.
+# Only fit() needs numpy. With an up to date artifact the regulation runs without it (low memory boards): artifacts
+# can be compiled offline, then copied next to the CSV files.
+#
+# $> python3 calibration_cache.py power_calibration_ecs.csv [...]
+#
+# Layout (native byte order, float64 arrays):
+#   header  : magic, sha256 key (32 bytes), degree, len(power_tab), len(percent_tab), max_power
+#   arrays  : coefficients (degree+1, highest power first), power_tab, percent_tab
+
+import hashlib, mmap, os, struct, sys
+from array import array
+from debug_log import debug as debug
+
+MAGIC = b'PVCAL001'
+HEADER = struct.Struct('=8s32sIIIi')
+
+
+def cache_file(calibration_file):
+    return calibration_file + '.cache'
+
+def key(calibration_file, degree):
+    """ Return the key of a calibration: sha256 of the CSV content and of the polynomial degree"""
+    with open(calibration_file, 'rb') as f:
+        h = hashlib.sha256(f.read())
+    h.update(struct.pack('=I', degree))
+    return h.digest()
+
+def load(calibration_file, degree):
+    """ Return (coefficients, power_tab, percent_tab, max_power) from the artifact, or None if it is missing or stale.
+    The tables are float64 memoryviews over the mapped file."""
+    try:
+        k = key(calibration_file, degree)
+        with open(cache_file(calibration_file), 'rb') as f:
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+    if len(m) < HEADER.size:
+        return None
+    magic, stored_key, stored_degree, n_power, n_percent, max_power = HEADER.unpack_from(m)
+    if magic != MAGIC or stored_key != k or stored_degree != degree \
+            or len(m) != HEADER.size + 8 * (degree + 1 + n_power + n_percent):
+        debug(2, "calibration cache of " + calibration_file + " is stale")
+        return None
+    values = memoryview(m)[HEADER.size:].cast('d')
+    coefficients = values[:degree + 1]
+    power_tab = values[degree + 1:degree + 1 + n_power]
+    percent_tab = values[degree + 1 + n_power:]
+    return coefficients, power_tab, percent_tab, max_power
+
+def polyval(coefficients, x):
+    """ Evaluate the polynomial (coefficients highest power first) at x, Horner scheme"""
+    y = 0.0
+    for c in coefficients:
+        y = y * x + c
+    return y
+
+def fit(calibration_file, degree):
+    """ Fit the calibration CSV (percent;watt), return (coefficients, power_tab, percent_tab, max_power)
+    power_tab[k] is the power at k/2 percent, percent_tab[w] is the percent giving w watts"""
+    import numpy as np
+    with open(calibration_file) as f:
+        measures = np.loadtxt(f, delimiter=";")
+    coefficients = np.polyfit(measures[:, 0], measures[:, 1], degree)
+    # the fitted polynomial may dip (see the calibration measures), the curve is made monotonic with a running max
+    # so that a power always maps to the lowest percent reaching it
+    tab = np.maximum.accumulate(np.polyval(coefficients, np.arange(0, 100.5, 0.5)))
+    watts = np.arange(max(int(tab[-1]), 0) + 1)
+    i = np.clip(np.searchsorted(tab, watts, side='left'), 1, len(tab) - 1)
+    dist = tab[i] - tab[i - 1]
+    ratio = np.divide(watts - tab[i - 1], dist, out=np.ones(len(watts)), where=dist > 0)
+    percents = (i - 1) * 0.5 + 0.5 * np.clip(ratio, 0, 1)
+    return (array('d', coefficients.tolist()), array('d', tab.tolist()), array('d', percents.tolist()),
+            int(polyval(coefficients.tolist(), 100)))
+
+def save(calibration_file, degree, coefficients, power_tab, percent_tab, max_power):
+    """ Write the artifact atomically (a reader never maps a partial file)"""
+    path = cache_file(calibration_file)
+    tmp = path + '.tmp'
+    try:
+        with open(tmp, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, key(calibration_file, degree), degree, len(power_tab), len(percent_tab),
+                                int(max_power)))
+            for values in (coefficients, power_tab, percent_tab):
+                array('d', values).tofile(f)
+        os.replace(tmp, path)
+    except OSError as e:
+        # read-only installation: the calibration is fitted at each start
+        debug(2, "cannot write calibration cache " + path + " : " + str(e))
+
+
+if __name__ == '__main__':
+    degree = 5
+    for calibration_file in sys.argv[1:]:
+        calibration = fit(calibration_file, degree)
+        save(calibration_file, degree, *calibration)
+        print("{} -> {} : max power {} W".format(calibration_file, cache_file(calibration_file), calibration[3]))
@@ -0,0 +1,56 @@
+# Copyright (C) 2020-2022 Coturex - F5RQG
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Clock of the regulation. now_ts() of the regulation and equipment modules reads the installed clock: the wall clock
+# in production, a VirtualClock when a recorded day is replayed faster than real time (see replay.py).
+
+import time
+
+
+class WallClock:
+    def time(self):
+        return time.time()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+
+class VirtualClock:
+    """ Clock moved by the caller, sleep() just advances it"""
+    def __init__(self, ts=0):
+        self.ts = ts
+
+    def time(self):
+        return self.ts
+
+    def sleep(self, seconds):
+        self.ts += seconds
+
+    def set(self, ts):
+        self.ts = ts
+
+
+_clock = WallClock()
+
+def now_ts():
+    return _clock.time()
+
+def sleep(seconds):
+    _clock.sleep(seconds)
+
+def set_clock(c):
+    """ Install a clock, return the previous one"""
+    global _clock
+    previous = _clock
+    _clock = c
+    return previous
@@ -25,13 +25,12 @@
 #
 #  -> JSON format every 3 hours (0 to 7)
 
-import requests   
 import sys
 import datetime
 from pprint import pprint
 from debug_log import debug as debug
 from debug_log import log as log
-import numpy as np
+# requests is imported on first use, it is slow to load on a Pi Zero and only needed once a day
 
 TODAY = 0 
 DEMAIN = 1
@@ -60,6 +59,7 @@ class Prediction:
         try:
             url = "https://wttr.in/{}?format=j1".format(self.location)
             debug(0, "Cloud_prediction url : " + url)
+            import requests
             wdata = requests.get(url).json()
             # pprint(wdata)
             i = 0
@@ -96,6 +96,7 @@ class Prediction:
         """Print JSON data returned by html request"""
         try:
             url = "https://wttr.in/{}?format=j1".format(self.location)
+            import requests
             wdata = requests.get(url).json()
             pprint(wdata)
         except:
@@ -105,6 +106,7 @@ class Prediction:
         """ Return percent of clouds at specific Hour, DAY"""
         try:
             url = "https://wttr.in/{}?format=j1".format(self.location)
+            import requests
             wdata = requests.get(url).json()
             # pprint(wdata)
             h = int(sHour/3)
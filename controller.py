@@ -0,0 +1,163 @@
+# Copyright (C) 2020-2022 Coturex - F5RQG
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Closed loop control of the variable power equipments.
+# - PIController: PI controller in velocity form. The allocation plan gives the power the equipment should absorb, the
+#   difference with the current command is the error. The output is a power setpoint which is converted to a percent
+#   through the calibrated curve of the equipment (power_to_percent): this is the feed-forward path, the PI only
+#   corrects what the curve and the delayed PZEM measurement leave. With kp = 0 and ki * period = 1, it behaves like
+#   the raw mode (the whole error is added to the command at each cycle).
+#   Anti-windup: the integral of the velocity form is the command itself, it is clamped to the power range.
+# - StepResponse: measures the overshoot and the settling time of the power balance after a step (PV transient,
+#   load switched in the house...), so that the control modes can be compared.
+# - ConsumptionPredictor: consumption between two PZEM readings. A reading does not include the power commanded less
+#   than 'settle' seconds before it (load response, PZEM integration), the prediction is the last reading plus these
+#   commanded deltas. When the next reading comes, the deltas it includes are dropped and the prediction error is
+#   recorded.
+
+import collections
+
+class PIController:
+    def __init__(self, kp, ki, period):
+        self.kp = kp
+        self.ki = ki
+        self.period = period
+        self.last_error = 0
+        self.last_ts = None
+
+    def update(self, error, command, low, high, ts):
+        """ Return the new command (W) for the given error (W), clamped to [low, high]"""
+        dt = self.period
+        if self.last_ts is not None and 0 < ts - self.last_ts < 4 * self.period:
+            dt = ts - self.last_ts
+        self.last_ts = ts
+        u = command + self.kp * (error - self.last_error) + self.ki * dt * error
+        self.last_error = error
+        if u > high:
+            u = high
+        elif u < low:
+            u = low
+        return u
+
+
+class StepResponse:
+    def __init__(self, band, step=200, settle_cycles=3, timeout=600):
+        self.band = band                    # balanced when |error| < band (W)
+        self.step = step                    # a step starts when |error| >= step (W)
+        self.settle_cycles = settle_cycles  # consecutive cycles in the band to be settled
+        self.timeout = timeout              # give up tracking a step after this duration (s)
+        self.tracking = False
+        self.steps = 0
+        self.settled = 0
+        self.settling_time = None
+        self.settling_cycles = None
+        self.overshoot = None
+        self.overshoot_percent = None
+        self.settling_time_sum = 0
+        self.settling_cycles_sum = 0
+
+    def update(self, error, ts):
+        """ Feed the balance error (production - margin - consumption) of an evaluation"""
+        if not self.tracking:
+            if abs(error) >= self.step:
+                self.tracking = True
+                self.steps += 1
+                self.sign = 1 if error > 0 else -1
+                self.amplitude = abs(error)
+                self.start_ts = ts
+                self.cycles = 0
+                self.in_band = 0
+                self.in_band_ts = None
+                self.peak = 0
+            return
+        self.cycles += 1
+        if self.sign * error < 0 and -self.sign * error > self.peak:
+            self.peak = -self.sign * error
+        if abs(error) < self.band:
+            if self.in_band == 0:
+                self.in_band_ts = ts
+                self.in_band_cycles = self.cycles
+            self.in_band += 1
+            if self.in_band >= self.settle_cycles:
+                self.tracking = False
+                self.settled += 1
+                self.settling_time = self.in_band_ts - self.start_ts
+                self.settling_cycles = self.in_band_cycles
+                self.overshoot = self.peak
+                self.overshoot_percent = round(100 * self.peak / self.amplitude)
+                self.settling_time_sum += self.settling_time
+                self.settling_cycles_sum += self.settling_cycles
+        else:
+            self.in_band = 0
+            if ts - self.start_ts > self.timeout:
+                self.tracking = False
+
+    def stats(self):
+        """ Return the last step response and the averages over the settled steps"""
+        return {
+            'steps': self.steps,
+            'settled': self.settled,
+            'settling_time': None if self.settling_time is None else round(self.settling_time, 1),
+            'settling_cycles': self.settling_cycles,
+            'overshoot': None if self.overshoot is None else int(self.overshoot),
+            'overshoot_percent': self.overshoot_percent,
+            'settling_time_avg': round(self.settling_time_sum / self.settled, 1) if self.settled else None,
+            'settling_cycles_avg': round(self.settling_cycles_sum / self.settled, 1) if self.settled else None,
+        }
+
+
+class ConsumptionPredictor:
+    def __init__(self, settle=1.5, history=64):
+        self.settle = settle
+        self.commands = collections.deque(maxlen=history)      # (date, commanded delta W) not in the last reading
+        self.last_total = None
+        self.consumption = None
+        self.reading_date = None
+        self.readings = 0
+        self.error_sum = 0
+        self.corrected = 0          # evaluations made on a predicted consumption
+
+    def _included(self, date):
+        """ Sum of the commanded deltas included in a reading taken at date, they are dropped"""
+        cutoff = date - self.settle
+        included = 0
+        while self.commands and self.commands[0][0] <= cutoff:
+            included += self.commands.popleft()[1]
+        return included
+
+    def predict(self, consumption, reading_date):
+        """ Return the consumption predicted from the last reading (consumption, taken at reading_date)"""
+        if reading_date != self.reading_date:
+            included = self._included(reading_date)
+            if self.consumption is not None:
+                self.error_sum += abs(consumption - (self.consumption + included))
+                self.readings += 1
+            self.consumption = consumption
+            self.reading_date = reading_date
+        pending = sum(d for ts, d in self.commands)
+        if pending:
+            self.corrected += 1
+        return consumption + pending
+
+    def commanded(self, total, ts):
+        """ Total power commanded to the equipments after an evaluation at ts"""
+        if self.last_total is not None and total != self.last_total:
+            self.commands.append((ts, total - self.last_total))
+        self.last_total = total
+
+    def stats(self):
+        return {
+            'settle': self.settle,
+            'corrected': self.corrected,
+            'error_avg': round(self.error_sum / self.readings, 1) if self.readings else None,
+        }
@@ -14,10 +14,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import logging
-import configparser
-config = configparser.ConfigParser()
-config.read('config.ini')
+# Logs of the regulation: debug_file (debug) and log_file (info) of the [debug] section.
+# debug(indent, msg, *args) and log(indent, msg, *args) take %-style arguments, the message is built only when its
+# file is enabled. The records are put on a queue and written by a background thread (QueueListener), so the control
+# loop never waits on the storage. The files can be rotated by size and/or age and the rotated files gzipped, without
+# the log_* keys in config.ini they are never rotated (one file growing, as before).
+
+import atexit, gzip, logging, logging.handlers, os, queue, shutil, time
+from libccx import config
 
 debugger = logging.getLogger('regulation_debug')
 debugger.setLevel(logging.DEBUG)
@@ -29,51 +33,131 @@ logger.setLevel(logging.INFO)
 formatter = logging.Formatter('%(asctime)s - %(message)s')
 
 unset_words = ("none", "None", "NONE", "false", "False", "FALSE", "nok", "NOK")
+set_words = ("true", "True", "TRUE", "ok", "OK")
 
 try:
-    debug_file_name = config['debug']['debug_file']
-    if debug_file_name in unset_words:
-        DEBUG = False 
-    else:
-        DEBUG = True
-        ch1 = logging.StreamHandler()
-        ch1.setLevel(logging.DEBUG)
-        ch1 = logging.FileHandler(debug_file_name)
-        ch1.setFormatter(formatter)
-        debugger.addHandler(ch1)
+    MAX_SIZE = int(float(config['debug']['log_max_size']) * 1024 * 1024)
 except Exception:
-    DEBUG = False
-
+    MAX_SIZE = 0
 try:
-    log_file_name = config['debug']['log_file']
-    if log_file_name in unset_words:
-        LOG = False 
-    else:
-        LOG = True
-        ch2 = logging.StreamHandler()
-        ch2.setLevel(logging.INFO)
-        ch2 = logging.FileHandler(log_file_name)
-        ch2.setFormatter(formatter)
-        logger.addHandler(ch2)
+    ROTATE_INTERVAL = float(config['debug']['log_rotate']) * 3600
 except Exception:
-    LOG = False
+    ROTATE_INTERVAL = 0
+try:
+    BACKUP_COUNT = max(1, int(config['debug']['log_backups']))
+except Exception:
+    BACKUP_COUNT = 5
+try:
+    COMPRESS = config['debug']['log_compress'] in set_words
+except Exception:
+    COMPRESS = False
+try:
+    QUEUED = config['debug']['log_queue'] not in unset_words
+except Exception:
+    QUEUED = True
+
+DEBUG = False
+LOG = False
+_handlers = []
+_listener = None
+
+
+def gzip_rotator(source, dest):
+    with open(source, 'rb') as f_in, gzip.open(dest, 'wb') as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    os.remove(source)
 
-def debug(indent, msg):
-    global DEBUG
-    if DEBUG:
-        debugger.debug(('  '*indent)+str(msg))
 
-def log(indent, msg):
-    global LOG
-    if LOG:
-        logger.info(('  '*indent)+str(msg))
+class RotatingHandler(logging.handlers.RotatingFileHandler):
+    """ Log file rotated when it reaches max_bytes or every interval seconds (0 disables either), the backups are
+    name.1 (newest) ... name.<backups>, gzipped if compress"""
+    def __init__(self, filename, max_bytes, interval, backups, compress):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backups, delay=True)
+        self.interval = interval
+        self.rollover_at = time.time() + interval if interval > 0 else None
+        if compress:
+            self.namer = lambda name: name + '.gz'
+            self.rotator = gzip_rotator
+
+    def shouldRollover(self, record):
+        if self.rollover_at is not None and record.created >= self.rollover_at:
+            return True
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        super().doRollover()
+        if self.rollover_at is not None:
+            self.rollover_at = time.time() + self.interval
+
+
+class MessageQueueHandler(logging.handlers.QueueHandler):
+    """ Queue the record with its message merged (the arguments may change later), the line is formatted and written
+    by the listener thread"""
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+def configure(debug_file, log_file, queued=QUEUED):
+    """ (Re)open the debug and log files, None or an unset word disables a file"""
+    global DEBUG, LOG, _listener
+    close()
+    handlers = []
+    for l, file_name in ((debugger, debug_file), (logger, log_file)):
+        if file_name is None or file_name in unset_words:
+            continue
+        h = RotatingHandler(file_name, MAX_SIZE, ROTATE_INTERVAL, BACKUP_COUNT, COMPRESS)
+        h.setFormatter(formatter)
+        h.addFilter(logging.Filter(l.name))
+        handlers.append((l, h))
+    DEBUG = any(l is debugger for l, h in handlers)
+    LOG = any(l is logger for l, h in handlers)
+    if queued and handlers:
+        q = queue.SimpleQueue()
+        _listener = logging.handlers.QueueListener(q, *[h for l, h in handlers])
+        _listener.start()
+        for l, h in handlers:
+            qh = MessageQueueHandler(q)
+            l.addHandler(qh)
+            _handlers.append((l, qh))
+    else:
+        for l, h in handlers:
+            l.addHandler(h)
+    _handlers.extend(handlers)
+
+def close():
+    """ Write the queued records and close the files"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+    for l, h in _handlers:
+        l.removeHandler(h)
+        h.close()
+    _handlers.clear()
+
+def read_file_option(name):
+    try:
+        return config['debug'][name]
+    except Exception:
+        return None
+
+configure(read_file_option('debug_file'), read_file_option('log_file'))
+atexit.register(close)
+
+def debug(indent, msg, *args):
+    if DEBUG and debugger.isEnabledFor(logging.DEBUG):
+        debugger.debug(('  '*indent)+str(msg), *args)
+
+def log(indent, msg, *args):
+    if LOG and logger.isEnabledFor(logging.INFO):
+        logger.info(('  '*indent)+str(msg), *args)
 
 
 def main():
     debug(0,"debug")
-    log(0,"info")
+    log(0,"info %s", "lazy")
   
 if __name__ == '__main__':
     main()
-
- 
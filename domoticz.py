@@ -0,0 +1,109 @@
+# Copyright (C) 2020-2022 Coturex - F5RQG
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Domoticz output of the regulation: the values of the idx devices (grid, injection) sent on domoticz/in.
+# - a change between zero and non zero is sent at once. A non zero value following more than 'zero_anchor' seconds of
+#   zero is preceded by a 0, and a value back to zero is sent once : the Grafana integral of the Influx points starts
+#   and ends at 0
+# - the non zero values are coalesced : their average is sent once per 'period' seconds, if it moved by 'deadband' W
+#   or more from the last sent value
+# - 'keepalive' : the last value is sent again after this many seconds without a message
+# - the messages that cannot be published (broker unreachable) wait in a bounded queue, the oldest are dropped. The
+#   queue is flushed at the next update once the broker is back
+
+import collections, json
+
+
+class Device:
+    def __init__(self, idx, keepalive=None):
+        self.idx = idx
+        self.keepalive = keepalive
+        self.last_value = None      # last sent value
+        self.last_sent = None
+        self.last_nonzero = None    # date of the last non zero update
+        self.window_start = None    # start of the averaging period
+        self.sum = 0
+        self.samples = 0
+
+
+class DomoticzOutput:
+    def __init__(self, topic, period=0, deadband=0, zero_anchor=20, queue_size=100):
+        self.topic = topic
+        self.period = period
+        self.deadband = deadband
+        self.zero_anchor = zero_anchor
+        self.devices = {}
+        self.queue = collections.deque(maxlen=queue_size)
+        # statistics
+        self.updates = 0
+        self.published = 0
+        self.dropped = 0
+
+    def add(self, name, idx, keepalive=None):
+        self.devices[name] = Device(idx, keepalive)
+
+    def update(self, client, name, value, t):
+        """ New value of the device name at t, publish what is due"""
+        d = self.devices[name]
+        self.updates += 1
+        if self.queue:
+            self.flush(client)
+        if value == 0:
+            if d.last_value is None or d.last_value != 0:
+                self._send(client, d, 0, t)
+            elif d.keepalive is not None and t - d.last_sent > d.keepalive:
+                self._send(client, d, 0, t)
+            return
+        previous = d.last_nonzero
+        d.last_nonzero = t
+        if d.last_value is None or d.last_value == 0:
+            if d.last_value == 0 and (previous is None or t - previous > self.zero_anchor):
+                self._send(client, d, 0, t)
+            self._send(client, d, value, t)
+            return
+        d.sum += value
+        d.samples += 1
+        if t - d.window_start >= self.period:
+            # the period is over, sent or not its average starts a new one
+            average = round(d.sum / d.samples)
+            d.sum = d.samples = 0
+            d.window_start = t
+            if abs(average - d.last_value) >= self.deadband or \
+                    (d.keepalive is not None and t - d.last_sent > d.keepalive):
+                self._send(client, d, average, t)
+
+    def _send(self, client, d, value, t):
+        d.last_value = value
+        d.last_sent = t
+        d.window_start = t
+        d.sum = d.samples = 0
+        if len(self.queue) == self.queue.maxlen:
+            self.dropped += 1
+        self.queue.append(json.dumps({'idx': int(d.idx), 'nvalue': 0, 'svalue': str(value)}))
+        self.flush(client)
+
+    def flush(self, client):
+        """ Publish the queued messages, they stay queued while the broker is unreachable"""
+        connected = getattr(client, 'is_connected', None)
+        if connected is not None and not connected():
+            return
+        while self.queue:
+            info = client.publish(self.topic, self.queue[0])
+            if getattr(info, 'rc', 0) != 0:
+                return
+            self.queue.popleft()
+            self.published += 1
+
+    def stats(self):
+        return {'updates': self.updates, 'published': self.published, 'queued': len(self.queue),
+                'dropped': self.dropped}
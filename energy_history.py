@@ -0,0 +1,188 @@
+#!/usr/bin/python3
+
+# Copyright (C) 2020-2022 Coturex - F5RQG
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Energy history: production, consumption, grid, injection and energy of every equipment (Wh), by minute, hour and
+# day (local time), in three ring buffers of a memory mapped file. The file is the storage, there is nothing to load
+# at start and the kernel writes the pages back.
+# sample() integrates the powers of each evaluation and adds the energy to the current minute, hour and day slots, so
+# hourly() and daily() read the rollups directly, without scanning the minutes.
+# File: header (MAGIC, slot counts, column names), then the minutes, hours and days rings. A slot is float64 values:
+# its key (local minute / hour / day since the epoch), then one value per column. A slot holding an older key is
+# cleared when it is reused. The file is recreated if the columns or the sizes change.
+#
+# $> python3 energy_history.py energy_history.bin [--day 2022-10-18] [--days 7]
+
+import argparse, datetime, mmap, os, struct, time
+
+MAGIC = b'PVHIST01'
+HEADER = struct.Struct('<8sIIII')       # magic, columns, minutes, hours, days
+NAME_SIZE = 32
+COLUMNS = ('production', 'consumption', 'grid', 'injection')
+
+
+class EnergyHistory:
+    def __init__(self, path, equipments, minutes=2880, hours=24 * 62, days=3660, max_gap=60):
+        self.path = path
+        self.columns = COLUMNS + tuple(equipments)
+        self.sizes = (minutes, hours, days)
+        self.max_gap = max_gap
+        self.width = 1 + len(self.columns)
+        self.header_size = HEADER.size + NAME_SIZE * len(self.columns)
+        self.header_size += -self.header_size % 8
+        size = self.header_size + sum(self.sizes) * self.width * 8
+        self.recreated = not self._valid(size)
+        if self.recreated:
+            self._create(size)
+        self.file = open(path, 'r+b')
+        self.mm = mmap.mmap(self.file.fileno(), size)
+        data = memoryview(self.mm)[self.header_size:].cast('d')
+        self.rings = []
+        offset = 0
+        for slots in self.sizes:
+            self.rings.append(data[offset:offset + slots * self.width])
+            offset += slots * self.width
+        self.last_t = None
+        self.last = None
+        self.gmtoff_hour = None
+        self.gmtoff = 0
+
+    def _header(self):
+        names = b''.join(c.encode()[:NAME_SIZE].ljust(NAME_SIZE, b'\0') for c in self.columns)
+        return HEADER.pack(MAGIC, len(self.columns), *self.sizes) + names
+
+    def _valid(self, size):
+        try:
+            if os.path.getsize(self.path) != size:
+                return False
+            with open(self.path, 'rb') as f:
+                return f.read(self.header_size).rstrip(b'\0') == self._header().rstrip(b'\0')
+        except OSError:
+            return False
+
+    def _create(self, size):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(self._header().ljust(self.header_size, b'\0'))
+            f.truncate(size)
+        os.replace(tmp, self.path)
+
+    def local(self, ts):
+        """ Local time in seconds since the epoch (the UTC offset is read once per hour)"""
+        hour = int(ts // 3600)
+        if hour != self.gmtoff_hour:
+            self.gmtoff_hour = hour
+            self.gmtoff = time.localtime(ts).tm_gmtoff
+        return ts + self.gmtoff
+
+    def add(self, ts, values):
+        """ Add the energies values (Wh, one per column) at ts"""
+        local = self.local(ts)
+        key = int(local // 60)
+        for ring, slots, k in zip(self.rings, self.sizes, (key, key // 60, int(local // 86400))):
+            i = (k % slots) * self.width
+            if ring[i] != k:
+                ring[i] = k
+                for j in range(i + 1, i + self.width):
+                    ring[j] = 0.0
+            for j, v in enumerate(values, i + 1):
+                ring[j] += v
+
+    def sample(self, t, production, consumption, powers):
+        """ Integrate the powers (W) held since the previous sample, powers of the equipments in the columns order"""
+        if self.last_t is not None:
+            dt = t - self.last_t
+            if 0 < dt <= self.max_gap:
+                prod, cons, previous = self.last
+                h = dt / 3600.0
+                net = cons - prod
+                values = [prod * h, cons * h, max(net, 0) * h, max(-net, 0) * h]
+                values.extend(p * h for p in previous)
+                self.add(self.last_t, values)
+        self.last_t = t
+        self.last = (production, consumption, powers)
+
+    def _slot(self, ring, k):
+        slots = self.sizes[ring]
+        i = (k % slots) * self.width
+        r = self.rings[ring]
+        if r[i] != k:
+            return None
+        return dict(zip(self.columns, r[i + 1:i + self.width].tolist()))
+
+    def hourly(self, day):
+        """ Totals of the 24 hours of day (datetime.date), None for the hours not recorded"""
+        first = day.toordinal() - datetime.date(1970, 1, 1).toordinal()
+        return [self._slot(1, first * 24 + h) for h in range(24)]
+
+    def daily(self, first, last):
+        """ {date: totals} of the recorded days from first to last (datetime.date)"""
+        epoch = datetime.date(1970, 1, 1).toordinal()
+        totals = {}
+        for o in range(first.toordinal(), last.toordinal() + 1):
+            t = self._slot(2, o - epoch)
+            if t is not None:
+                totals[datetime.date.fromordinal(o)] = t
+        return totals
+
+    def minutes(self, start, end):
+        """ [(ts, totals)] of the recorded minutes between the timestamps start and end"""
+        offset = self.local(start) - start
+        result = []
+        for k in range(int((start + offset) // 60), int((end + offset) // 60) + 1):
+            t = self._slot(0, k)
+            if t is not None:
+                result.append((k * 60 - offset, t))
+        return result
+
+    def flush(self):
+        self.mm.flush()
+
+    def close(self):
+        self.rings = []
+        self.mm.flush()
+        self.mm.close()
+        self.file.close()
+
+
+def read_columns(path):
+    """ Columns and sizes of a history file"""
+    with open(path, 'rb') as f:
+        magic, n, minutes, hours, days = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC:
+            raise ValueError(path + " is not an energy history")
+        names = [f.read(NAME_SIZE).rstrip(b'\0').decode() for i in range(n)]
+    return names[len(COLUMNS):], (minutes, hours, days)
+
+def main():
+    parser = argparse.ArgumentParser(description="hourly and daily energies of the history")
+    parser.add_argument('path')
+    parser.add_argument('--day', type=datetime.date.fromisoformat, default=datetime.date.today(),
+                        help="hourly totals of this day (YYYY-MM-DD), today by default")
+    parser.add_argument('--days', type=int, default=7, help="daily totals of the last days")
+    args = parser.parse_args()
+    equipments, (minutes, hours, days) = read_columns(args.path)
+    history = EnergyHistory(args.path, equipments, minutes, hours, days)
+    columns = history.columns
+    print("{:16}".format('Wh') + ''.join("{:>12}".format(c[:11]) for c in columns))
+    for h, totals in enumerate(history.hourly(args.day)):
+        if totals is not None:
+            print("{} {:02}h   ".format(args.day, h) + ''.join("{:12.0f}".format(totals[c]) for c in columns))
+    print()
+    for day, totals in history.daily(args.day - datetime.timedelta(days=args.days - 1), args.day).items():
+        print("{}      ".format(day) + ''.join("{:12.0f}".format(totals[c]) for c in columns))
+    history.close()
+
+if __name__ == '__main__':
+    main()
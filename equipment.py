@@ -26,20 +26,26 @@
 # - ConstantPowerEquipment: an equipment which load is fixed and known. It can be controlled like a switch.
 #       ConstantPowerEquipment is essentially an optimization of UnknownPowerEquipment as it will allow the regulation
 #       loop to match power consumption and production faster.
-import time, sys
+import sys, threading
 from os.path import exists
 from debug_log import log as log
 from debug_log import debug as debug
-import numpy as np
-from debug_log import debug as debug
+from controller import PIController
+import calibration_cache
+import clock
 
-import configparser
-config = configparser.ConfigParser()
-config.read('config.ini')
+from libccx import config
 
 unset_words = ("none", "None", "NONE", "false", "False", "FALSE", "nok", "NOK")
 set_words = ("true", "True", "TRUE", "ok", "OK", )
 
+# over detection (thermostat): an equipment is overed when its measured power stays near 0 for more than
+# COUNTER_LIMIT consecutive checks while it is commanded
+try:
+    COUNTER_LIMIT = int(config['evaluate']['counter_limit'])
+except Exception:
+    COUNTER_LIMIT = 5
+
 if (config['debug']['equipment_stdout'] in set_words): 
     EDEBUG = True 
 else: EDEBUG = False
@@ -58,7 +64,23 @@ def setup(mqtt_client, simulation, prefix):
         _prefix = prefix
 
 def now_ts():
-    return time.time()
+    return clock.now_ts()
+
+# Outbound command stage. Between begin_cycle() and end_cycle() (an evaluation), the commands are held and only the
+# last one of each equipment is sent. Commands equal to the last sent one, or within the equipment deadband, are
+# suppressed and counted. The cycle belongs to the thread which began it: a command from another thread (signal
+# handler, forced mode) is sent at once, it is never held by the cycle of an other thread.
+_cycle = threading.local()
+
+def begin_cycle():
+    _cycle.pending = {}
+
+def end_cycle():
+    pending = getattr(_cycle, 'pending', None)
+    _cycle.pending = None
+    if pending:
+        for e, (payload, value) in pending.items():
+            e.publish_command(payload, value)
 
     
 ##########################################################################
@@ -76,6 +98,13 @@ class Equipment:
         self.current_power = None
         self.last_power_change_date = None
         self.measured_power = None
+        self.measured_new = False   # a reading came since the last check_over
+        self.measured_date = None
+        self.read_period = None     # interval between the last two readings
+        self.controller = None
+        self.last_command = None
+        self.commands_sent = 0
+        self.commands_suppressed = 0
         try:
             self.topic_read_power = config[self.name]['topic_read_power']
             if (self.topic_read_power in unset_words):
@@ -111,6 +140,30 @@ class Equipment:
     def get_current_power(self):
         return self.current_power
 
+    def send_command(self, payload, value):
+        """ Publish payload on topic_set_power, value is the command compared to the last sent one"""
+        pending = getattr(_cycle, 'pending', None)
+        if pending is None:
+            self.publish_command(payload, value)
+            return
+        if self in pending:
+            # coalesced: only the last command of the cycle is sent
+            self.commands_suppressed += 1
+        pending[self] = (payload, value)
+
+    def publish_command(self, payload, value):
+        if self.last_command is not None and self.in_deadband(value):
+            self.commands_suppressed += 1
+            return
+        self.last_command = value
+        self.commands_sent += 1
+        if _send_commands:
+            _mqtt_client.publish(self.topic_set_power, payload, retain=True)
+
+    def in_deadband(self, value):
+        """ Return True if the command does not need to be sent, given the last sent one"""
+        return value == self.last_command
+
     def force(self, watt, duration=None):
         """ Force this equipment to the specified power in watt, for a given duration in seconds (None=forever)"""
         # implement in subclasses, watt may be ignored
@@ -143,18 +196,26 @@ class Equipment:
         # implement in subclasses, watt may be ignored
         return self.is_over_
 
-    def check_over(self):
-            COUNTER_LIMIT = 5  
+    def check_over(self, readings=False):
+            # readings : the readings of the equipment are counted instead of the evaluations (paired evaluations do
+            # not follow the rate of the readings), the checks are in a row up to 2.5 reading periods apart
+            window = 10
+            if readings:
+                if not self.measured_new:
+                    return
+                self.measured_new = False
+                if self.read_period is not None:
+                    window = max(window, 2.5 * self.read_period)
             ts = now_ts()
             if (self.measured_power < 5  and self.get_current_power() >= self.MIN_POWER):
                 if self.last_check_ts is not None:
-                    if ts - self.last_check_ts < 10: # if last_check is < 10s
+                    if ts - self.last_check_ts < window: # in a row
                         self.check_counter += 1
-                        debug(0, "[PARENT: check_over]" + self.name + " counter++ : " + str(self.check_counter)+ ", current_power/measured : " + str(self.get_current_power()) + " / " + str(self.measured_power))
+                        debug(0, "[PARENT: check_over]%s counter++ : %s, current_power/measured : %s / %s", self.name, self.check_counter, self.get_current_power(), self.measured_power)
                     else:
                         self.check_counter = 0
                     if self.check_counter > COUNTER_LIMIT:  # if power measure near 0-5W many times (5)
-                        debug(2, "[PARENT: check_over]" + self.name + " OVER LOADED : current_power/measured is " + str(self.get_current_power()) + " / " + str(self.measured_power))
+                        debug(2, "[PARENT: check_over]%s OVER LOADED : current_power/measured is %s / %s", self.name, self.get_current_power(), self.measured_power)
                         self.set_over()
                 self.last_check_ts = ts 
  
@@ -189,70 +250,85 @@ class VariablePowerEquipment(Equipment):
         self.power_tab = []
         self.MIN_POWER = int(config[self.name]['min_power'])
         self.MIN_PERCENT = int(config[self.name]['min_percent'])
+        # resolution of the variator (percent), commands closer than deadband (percent) to the last sent one are dropped
+        self.RESOLUTION = float(config[self.name].get('resolution', '0.1'))
+        self.DEADBAND = float(config[self.name].get('deadband', '0'))
         self.type = "variable"        
-        self.readCalibration("power_calibration_" + name +".csv")
+        # calibration of the variator, several equipments may share the same file
+        self.readCalibration(config[self.name].get('calibration_file', "power_calibration_" + name +".csv"))
+        # control mode : 'raw' adds the whole allocated power at each cycle, 'pi' shapes it with a PI controller
+        try:
+            control = config[self.name]['control']
+        except Exception:
+            control = 'raw'
+        if control == 'pi':
+            kp = float(config[self.name].get('kp', '0.2'))
+            ki = float(config[self.name].get('ki', '0.1'))
+            self.controller = PIController(kp, ki, float(config['evaluate']['period']))
+            log(2, "{} PI controller kp={} ki={}".format(self.name, kp, ki))
+
+    def control(self, target):
+        """ Return the power to command for the target of the allocation plan (shaped by the PI controller if any)"""
+        if self.controller is None or self.is_forced() or self.is_overed():
+            return target
+        power = self.controller.update(target - self.current_power, self.current_power, 0, self.MAX_POWER, now_ts())
+        if power < self.MIN_POWER:
+            # the variator cannot go below the minimal power
+            return 0
+        return int(power)
 
     def readCalibration(self, calibrationFile):
-        X = Y = None
-        try:
-            log(2,"Opening CSV : " + calibrationFile)
-            #self.MAX_POWER = readCSV(calibrationFile)
-            with open(calibrationFile) as file_name:
-                array = np.loadtxt(file_name, delimiter=";")
-            X = list(tuple(x[0] for x in array))
-            Y = list(tuple(x[1] for x in array))
-        except FileNotFoundError as fnf_error:
-            print(fnf_error)
-            log(2,fnf_error)
-            exit()
-        except Exception as e:
-            print(calibrationFile + " bad format, delimiter...")
-            print(e)
-            log(2,calibrationFile + " bad format, delimiter...")
-            log(2,e)
-            debug(1, "Error on line {}".format(sys.exc_info()[-1].tb_lineno))
-            exit()
-        self.poly_reg = np.poly1d(np.polyfit(X,Y, VariablePowerEquipment.POLYREG_DEGREE))
-        self.MAX_POWER= int(self.poly_reg(100))
-        # Remplissage du tableau de puissance 
-        for percent in np.arange(100, -0.5, -0.5):
-            P = (self.poly_reg(percent))
-            self.power_tab.append(P)
-        self.power_tab.reverse()    
-        # print(self.power_tab)
-      
+        # the fit needs numpy, the regulation runs without it when the compiled calibration is up to date
+        degree = VariablePowerEquipment.POLYREG_DEGREE
+        calibration = calibration_cache.load(calibrationFile, degree)
+        if calibration is not None:
+            log(2,"Calibration cache : " + calibration_cache.cache_file(calibrationFile))
+        else:
+            try:
+                log(2,"Opening CSV : " + calibrationFile)
+                calibration = calibration_cache.fit(calibrationFile, degree)
+            except FileNotFoundError as fnf_error:
+                print(fnf_error)
+                log(2,fnf_error)
+                exit()
+            except ImportError as e:
+                print(calibrationFile + " : numpy is needed to fit the calibration, or run calibration_cache.py offline")
+                log(2,calibrationFile + " : numpy is needed to fit the calibration, or run calibration_cache.py offline")
+                log(2,e)
+                exit()
+            except Exception as e:
+                print(calibrationFile + " bad format, delimiter...")
+                print(e)
+                log(2,calibrationFile + " bad format, delimiter...")
+                log(2,e)
+                debug(1, "Error on line {}".format(sys.exc_info()[-1].tb_lineno))
+                exit()
+            calibration_cache.save(calibrationFile, degree, *calibration)
+        self.poly_coeffs, self.power_tab, self.percent_tab, self.MAX_POWER = calibration
+
+    def poly_reg(self, percent):
+        """ Return the power (W) of the fitted calibration curve at percent"""
+        return calibration_cache.polyval(self.poly_coeffs, percent)
+
     def power_to_percent(self, value):
-        # search nearest value in array using dichotomic method
-        # and interpolate return value
+        """ Return the percent giving value watts, 100 above the calibrated range"""
         x = int(value)
-        n = len(self.power_tab)
-        lo = 0
-        hi = n - 1
-        mid = 0
-        if x < 0: return 0
-        while lo <= hi:
-            mid = (hi + lo) // 2
-            if self.power_tab[mid] < x:
-                lo = mid + 1
-                adj = 1
-            elif self.power_tab[mid] > x:
-                hi = mid - 1
-                adj = 0
-            else:
-                break
-        i = mid + adj
-        print("Adj = " + str(adj)) if EDEBUG else ''
-        if (i >= n): 
+        if x < 0:
+            return 0
+        if x >= len(self.percent_tab):
             return 100
-        else:
-            dist = self.power_tab[i] - self.power_tab[i-1]
-            print(dist)  if EDEBUG else ''
-            r = 0.5 / (dist / (int(value) - self.power_tab[i-1] ))
-            print(r)  if EDEBUG else ''
-            print(str(self.power_tab[i]) + " - " + str(self.power_tab[i-1])) if EDEBUG else ''
-            print(str(i/2) + " - " + str((i-1)/2)) if EDEBUG else ''
-            print("i = " + str(i)) if EDEBUG else ''
-            return (((i-1)/2+r))
+        return self.percent_tab[x]
+
+    def powers_to_percents(self, values):
+        """ Vectorized power_to_percent, for simulation and replay: return the array of percents for the watt values"""
+        import numpy as np
+        x = np.asarray(values).astype(int)
+        tab = np.asarray(self.percent_tab, dtype=float)
+        n = len(tab)
+        percents = tab[np.clip(x, 0, n - 1)]
+        percents[x < 0] = 0
+        percents[x >= n] = 100
+        return percents
 
     def set_current_power(self, power):
         # Super -> Call Parent function 
@@ -269,10 +345,20 @@ class VariablePowerEquipment(Equipment):
         if percent > 100:
             percent = 100
 
-        debug(4, "MQTT sending power command {}W ({}%) for {}".format(int(self.current_power), str(int(percent)), self.name))
-        debug(8, "in topic {}".format(self.topic_set_power))
-        if _send_commands:
-            _mqtt_client.publish(self.topic_set_power, str(percent), retain=True)
+        if self.RESOLUTION > 0:
+            percent = round(round(percent / self.RESOLUTION) * self.RESOLUTION, 3)
+
+        debug(4, "MQTT sending power command %dW (%d%%) for %s", self.current_power, percent, self.name)
+        debug(8, "in topic %s", self.topic_set_power)
+        self.send_command(str(percent), percent)
+
+    def in_deadband(self, value):
+        if value == self.last_command:
+            return True
+        if value == 0 or self.last_command == 0:
+            # turning on/off is always sent
+            return False
+        return abs(value - self.last_command) < self.DEADBAND
 
     def decrease_power_by(self, watt):
 
@@ -282,22 +368,22 @@ class VariablePowerEquipment(Equipment):
             decrease = watt
 
         if self.current_power - decrease < self.MIN_POWER:
-            debug(4, "turning off power because it is below the minimum power: "+str(self.MIN_POWER))
+            debug(4, "turning off power because it is below the minimum power: %s", self.MIN_POWER)
             decrease = self.current_power
 
         if decrease > 0:
             old = self.current_power
             new = self.current_power - decrease
-            debug(4, "decreasing power consumption of {} by {}W, from {} to {}".format(self.name, int(decrease), int(old), int(new)))
+            debug(4, "decreasing power consumption of %s by %dW, from %d to %d", self.name, decrease, old, new)
             self.set_current_power(new)
         else:
-            debug(4, "not decreasing power of {} because it is already at 0 W".format(self.name))
+            debug(4, "not decreasing power of %s because it is already at 0 W", self.name)
 
         return decrease
 
     def increase_power_by(self, watt):
         debug(4, "[PARENT: increase power by]") if EDEBUG else ''
-        debug(5, "{} currently {}, increase by {} W".format(self.name, self.current_power, int(watt))) if EDEBUG else ''
+        debug(5, "%s currently %s, increase by %d W", self.name, self.current_power, watt) if EDEBUG else ''
         
         if self.current_power + watt >= self.MAX_POWER:
             increase = self.MAX_POWER - self.current_power
@@ -306,19 +392,19 @@ class VariablePowerEquipment(Equipment):
             increase = watt
             remaining = 0
         if self.current_power + increase < self.MIN_POWER:
-            debug(4, "not increasing power because it doesn't reach the minimal power: "+str(self.MIN_POWER))
+            debug(4, "not increasing power because it doesn't reach the minimal power: %s", self.MIN_POWER)
             increase = 0
             remaining = watt
-        debug(5, "increase {}, remaining {}".format(int(increase), int(remaining))) if EDEBUG else ''
+        debug(5, "increase %d, remaining %d", increase, remaining) if EDEBUG else ''
         if increase == 0:
             debug(4, "status quo")
         elif increase > 0:
             old = self.current_power
             new = self.current_power + increase
-            debug(4, "increasing power consumption of {} by {}W, from {} to {}".format(self.name, int(increase) , int(old), int(new)))
+            debug(4, "increasing power consumption of %s by %dW, from %d to %d", self.name, increase, old, new)
             self.set_current_power(new)
         else:
-            debug(4, "not increasing power of {} because it is already at maximum power {} W".format(self.name, self.MAX_POWER))
+            debug(4, "not increasing power of %s because it is already at maximum power %s W", self.name, self.MAX_POWER)
 
         return remaining
 
@@ -344,36 +430,34 @@ class ConstantPowerEquipment(Equipment):
         # Super -> Call Parent function 
         super(ConstantPowerEquipment, self).set_current_power(power)
         self.is_on = power != 0
-        msg = '1' if self.is_on else '0'
-        if _send_commands:
-            if self.is_on:
-                msg = self.json_on 
-            else:
-                msg = self.json_off     
-            _mqtt_client.publish(self.topic_set_power, msg, retain=True)
-        debug(4, "sending power command {} for {}".format(self.is_on, self.name))
-        debug(8, "in topic {}".format(self.topic_set_power))
+        if self.is_on:
+            msg = self.json_on 
+        else:
+            msg = self.json_off     
+        self.send_command(msg, self.is_on)
+        debug(4, "sending power command %s for %s", self.is_on, self.name)
+        debug(8, "in topic %s", self.topic_set_power)
 
     def decrease_power_by(self, watt):
         if self.is_on:
-            debug(4, "shutting down {} with a consumption of {}W to recover {} W".format(self.name, self.max_power, watt))
+            debug(4, "shutting down %s with a consumption of %sW to recover %s W", self.name, self.max_power, watt)
             self.set_current_power(0)
             return self.max_power
         else:
-            debug(4, "{} with a power of {}W is already off".format(self.name, self.max_power))
+            debug(4, "%s with a power of %sW is already off", self.name, self.max_power)
             return 0
 
     def increase_power_by(self, watt):
         if self.is_on:
-            debug(4, "{} with a power of {}W is already on".format(self.name, self.max_power))
+            debug(4, "%s with a power of %sW is already on", self.name, self.max_power)
             return watt
         else:
             if watt >= self.max_power:
-                debug(4, "turning on {} with a consumption of {}W to use {} W".format(self.name, self.max_power, watt))
+                debug(4, "turning on %s with a consumption of %sW to use %s W", self.name, self.max_power, watt)
                 self.set_current_power(self.max_power)
                 return watt - self.max_power
             else:
-                debug(4, "not turning on {} with a consumption of {}W because it would use more than the available {} W".format(self.name, self.max_power, watt))
+                debug(4, "not turning on %s with a consumption of %sW because it would use more than the available %s W", self.name, self.max_power, watt)
                 return watt
 
     def force(self, watt, duration=None):
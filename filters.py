@@ -0,0 +1,129 @@
+# Copyright (C) 2020-2022 Coturex - F5RQG
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Filters of the sensor readings (the 'power' value of the PZEM messages, the json_read_power value of the equipment
+# readings), between the JSON decoding and the regulation. A chain is configured per topic in the [filters] section
+# of config.ini:
+#   consumption = hampel:7:3, average:3        (consumption / production : the sensor topics, or a topic name)
+# - average:N : moving average of the last N samples (ring buffer and running sum)
+# - median:N : median of the last N samples (ring buffer and sorted window)
+# - hampel:N:K : a sample further than K scaled MAD from the median of the last N samples is an outlier, it is replaced
+#   by this median and counted as rejected
+# The windows are bounded (MAX_WINDOW), the cost per sample does not depend on the number of samples received.
+
+import bisect
+
+MAX_WINDOW = 31
+MAD_SCALE = 1.4826     # MAD to standard deviation, normal distribution
+
+
+class MovingAverage:
+    def __init__(self, n):
+        self.ring = [0.0] * n
+        self.i = 0
+        self.count = 0
+        self.sum = 0.0
+
+    def filter(self, x):
+        n = len(self.ring)
+        if self.count == n:
+            self.sum -= self.ring[self.i]
+        else:
+            self.count += 1
+        self.ring[self.i] = x
+        self.sum += x
+        self.i = (self.i + 1) % n
+        return self.sum / self.count
+
+
+class Median:
+    def __init__(self, n):
+        self.ring = [None] * n
+        self.i = 0
+        self.window = []        # samples of the ring, sorted
+
+    def push(self, x):
+        old = self.ring[self.i]
+        if old is not None:
+            del self.window[bisect.bisect_left(self.window, old)]
+        self.ring[self.i] = x
+        self.i = (self.i + 1) % len(self.ring)
+        bisect.insort(self.window, x)
+
+    def median(self):
+        w = self.window
+        m = len(w) // 2
+        return w[m] if len(w) % 2 else (w[m - 1] + w[m]) / 2
+
+    def filter(self, x):
+        self.push(x)
+        return self.median()
+
+
+class Hampel(Median):
+    def __init__(self, n, k=3):
+        super().__init__(n)
+        self.k = k
+        self.rejected = 0
+
+    def filter(self, x):
+        self.push(x)
+        if len(self.window) < 3:
+            return x
+        med = self.median()
+        deviations = sorted(abs(v - med) for v in self.window)
+        mad = deviations[len(deviations) // 2]
+        if mad > 0 and abs(x - med) > self.k * MAD_SCALE * mad:
+            self.rejected += 1
+            return med
+        return x
+
+
+FILTERS = {'average': MovingAverage, 'median': Median, 'hampel': Hampel}
+
+
+class FilterChain:
+    def __init__(self, filters, spec=''):
+        self.filters = filters
+        self.spec = spec
+        self.samples = 0
+
+    def filter(self, x):
+        self.samples += 1
+        for f in self.filters:
+            x = f.filter(x)
+        return x
+
+    def stats(self):
+        return {'filters': self.spec, 'samples': self.samples,
+                'rejected': sum(getattr(f, 'rejected', 0) for f in self.filters)}
+
+
+def parse(spec):
+    """ Return the FilterChain of a spec 'hampel:7:3, average:3', ValueError if it is invalid"""
+    filters = []
+    for item in spec.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        name, *args = item.split(':')
+        if name not in FILTERS:
+            raise ValueError("unknown filter '{}' (average, median, hampel)".format(name))
+        n = int(args[0]) if args else 5
+        if n < 1 or n > MAX_WINDOW:
+            raise ValueError("filter window of '{}' out of 1..{}".format(item, MAX_WINDOW))
+        if name == 'hampel':
+            filters.append(Hampel(n, float(args[1]) if len(args) > 1 else 3))
+        else:
+            filters.append(FILTERS[name](n))
+    return FilterChain(filters, spec.strip())
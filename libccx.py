@@ -1,8 +1,9 @@
 #!/usr/bin/python3
 
-import time, datetime, os, psutil
+import time, datetime, os
 import configparser
 
+# config.ini is parsed once, the modules of the regulation share this object
 config = configparser.ConfigParser()
 config.read('config.ini') 
 
@@ -12,6 +13,7 @@ def now_ts():
 def checkProcessRunning(processName):
     # Checking if there is any running process that contains the given name processName.
     #Iterate over the all the running process
+    import psutil
     for proc in psutil.process_iter():
         try:
             # Check if process name contains the given name string.
@@ -0,0 +1,152 @@
+# Copyright (C) 2020-2022 Coturex - F5RQG
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Hot path instrumentation of the regulation: latency histograms of the stages (JSON decoding, evaluation, allocation
+# plan, status building, encoding, publishing) and received messages by topic.
+# A stage is timed with two perf_counter() calls and a bisect in fixed buckets, nothing is done when disabled.
+# - snapshot() : the last period (message rates, count / average / p50 / p95 / max latency), for the MQTT metrics topic
+# - prometheus() : the cumulative histograms and counters in the Prometheus text format (node_exporter textfile)
+
+import bisect, os, threading, time
+
+# bucket upper bounds (seconds)
+BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+           0.5, 1.0)
+
+enabled = False
+stages = {}
+messages = {}
+_window_messages = {}
+_window_start = time.monotonic()
+_lock = threading.Lock()
+
+
+class Histogram:
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKETS) + 1)   # the last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.window = [0] * (len(BUCKETS) + 1)
+        self.window_count = 0
+        self.window_sum = 0.0
+        self.window_max = 0.0
+
+    def observe(self, seconds):
+        i = bisect.bisect_left(BUCKETS, seconds)
+        self.buckets[i] += 1
+        self.count += 1
+        self.sum += seconds
+        self.window[i] += 1
+        self.window_count += 1
+        self.window_sum += seconds
+        if seconds > self.window_max:
+            self.window_max = seconds
+
+    def quantile(self, q):
+        """ Upper bound of the bucket holding the q quantile of the window (seconds)"""
+        rank = q * self.window_count
+        n = 0
+        for i, c in enumerate(self.window):
+            n += c
+            if n >= rank:
+                return min(BUCKETS[i], self.window_max) if i < len(BUCKETS) else self.window_max
+        return self.window_max
+
+    def window_stats(self):
+        if self.window_count == 0:
+            return {'count': 0}
+        return {
+            'count': self.window_count,
+            'avg_us': round(self.window_sum * 1e6 / self.window_count, 1),
+            'p50_us': round(self.quantile(0.5) * 1e6, 1),
+            'p95_us': round(self.quantile(0.95) * 1e6, 1),
+            'max_us': round(self.window_max * 1e6, 1),
+        }
+
+    def reset_window(self):
+        self.window = [0] * (len(BUCKETS) + 1)
+        self.window_count = 0
+        self.window_sum = 0.0
+        self.window_max = 0.0
+
+
+def enable(on=True):
+    global enabled
+    enabled = on
+
+def observe(stage, start):
+    """ Record the duration of stage, started at start (time.perf_counter())"""
+    if not enabled:
+        return
+    record(stage, time.perf_counter() - start)
+
+def record(stage, seconds):
+    """ Record a duration measured by the caller"""
+    if not enabled:
+        return
+    with _lock:
+        h = stages.get(stage)
+        if h is None:
+            h = stages[stage] = Histogram()
+        h.observe(seconds)
+
+def count(topic):
+    """ Count a received message"""
+    if not enabled:
+        return
+    with _lock:
+        messages[topic] = messages.get(topic, 0) + 1
+        _window_messages[topic] = _window_messages.get(topic, 0) + 1
+
+def snapshot():
+    """ Return the metrics of the period since the previous snapshot, and start a new period"""
+    global _window_start
+    with _lock:
+        now = time.monotonic()
+        period = now - _window_start
+        _window_start = now
+        msg = {
+            'period': round(period, 1),
+            'rates': {topic: round(n / period, 3) if period > 0 else 0 for topic, n in _window_messages.items()},
+            'stages': {name: h.window_stats() for name, h in stages.items()},
+        }
+        _window_messages.clear()
+        for h in stages.values():
+            h.reset_window()
+    return msg
+
+def prometheus():
+    """ Return the cumulative metrics in the Prometheus text format"""
+    lines = []
+    with _lock:
+        lines.append("# HELP pv_regulation_stage_seconds Duration of the regulation stages")
+        lines.append("# TYPE pv_regulation_stage_seconds histogram")
+        for name, h in sorted(stages.items()):
+            n = 0
+            for bound, c in zip(BUCKETS + ('+Inf',), h.buckets):
+                n += c
+                lines.append('pv_regulation_stage_seconds_bucket{{stage="{}",le="{}"}} {}'.format(name, bound, n))
+            lines.append('pv_regulation_stage_seconds_sum{{stage="{}"}} {}'.format(name, repr(h.sum)))
+            lines.append('pv_regulation_stage_seconds_count{{stage="{}"}} {}'.format(name, h.count))
+        lines.append("# HELP pv_regulation_messages_total MQTT messages received by topic")
+        lines.append("# TYPE pv_regulation_messages_total counter")
+        for topic, n in sorted(messages.items()):
+            lines.append('pv_regulation_messages_total{{topic="{}"}} {}'.format(topic.replace('"', '\\"'), n))
+    return "\n".join(lines) + "\n"
+
+def write_prometheus(path):
+    """ Write the Prometheus file atomically, a collector never reads a partial file"""
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write(prometheus())
+    os.replace(tmp, path)
@@ -0,0 +1,205 @@
+#!/usr/bin/python3
+
+# Copyright (C) 2020-2022 Coturex - F5RQG
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# MQTT trace of the regulation: every received message and every publication, timestamped, in an append-only binary
+# file. Cheap enough for the SD card of the Pi: writes are buffered and flushed every few seconds, the topics are
+# stored once per file (an id is written in each record), the files are rotated by size (trace.bin, trace.bin.1...).
+#
+# File : MAGIC, then records. Record : kind (uint8), ts (float64), topic id (uint16), length (uint32), payload.
+#   kind TOPIC    : declares the topic id, the payload is the topic name (ts is 0)
+#   kind RECEIVED : message received by the regulation
+#   kind SENT     : message published by the regulation
+# A record truncated by a power cut ends the file for the reader, and the recorder cuts it off before appending. A
+# record of an unknown kind or topic id (corrupted file) also ends the file.
+#
+# $> python3 mqtt_trace.py trace.bin [...]    (JSON lines, the format read by replay.py)
+
+import json, os, struct, sys, threading, time
+import clock
+
+MAGIC = b'PVTRACE1'
+RECORD = struct.Struct('<BdHI')
+TOPIC = 0
+RECEIVED = 1
+SENT = 2
+
+
+class Recorder:
+    def __init__(self, path, max_bytes=10000000, backup_count=5, flush_interval=10):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.records = 0
+        self.file = None
+        self._open()
+
+    def _open(self):
+        if os.path.exists(self.path):
+            # drop the tail of the last run (record torn by a power cut), the new records follow a complete one
+            end = valid_size(self.path)
+            if end != os.path.getsize(self.path):
+                os.truncate(self.path, end)
+        self.file = open(self.path, 'ab', buffering=65536)
+        self.size = self.file.tell()
+        if self.size == 0:
+            self.file.write(MAGIC)
+            self.size = len(MAGIC)
+        # the topics are declared again in the appended part, a file can be read from any restart
+        self.topics = {}
+        self.last_flush = time.monotonic()
+
+    def _rotate(self):
+        self.file.close()
+        if self.backup_count > 0:
+            for i in range(self.backup_count - 1, 0, -1):
+                src = "{}.{}".format(self.path, i)
+                if os.path.exists(src):
+                    os.replace(src, "{}.{}".format(self.path, i + 1))
+            os.replace(self.path, self.path + '.1')
+        else:
+            os.remove(self.path)
+        self._open()
+
+    def _write(self, kind, ts, topic_id, data):
+        self.file.write(RECORD.pack(kind, ts, topic_id, len(data)))
+        self.file.write(data)
+        self.size += RECORD.size + len(data)
+
+    def record(self, topic, payload, kind=RECEIVED, ts=None):
+        if payload is None:
+            data = b''
+        elif isinstance(payload, bytes):
+            data = payload
+        elif isinstance(payload, str):
+            data = payload.encode()
+        else:
+            data = str(payload).encode()
+        if ts is None:
+            ts = clock.now_ts()
+        with self.lock:
+            if self.file is None:
+                return
+            if self.size + RECORD.size + len(data) > self.max_bytes and self.size > len(MAGIC):
+                self._rotate()
+            topic_id = self.topics.get(topic)
+            if topic_id is None:
+                topic_id = len(self.topics)
+                self.topics[topic] = topic_id
+                self._write(TOPIC, 0, topic_id, topic.encode())
+            self._write(kind, ts, topic_id, data)
+            self.records += 1
+            now = time.monotonic()
+            if now - self.last_flush >= self.flush_interval:
+                self.file.flush()
+                self.last_flush = now
+
+    def flush(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.flush()
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+class TracedClient:
+    """ Proxy of a paho client, the publications are recorded before being sent"""
+    def __init__(self, client, recorder):
+        object.__setattr__(self, '_client', client)
+        object.__setattr__(self, '_recorder', recorder)
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self._recorder.record(topic, payload, SENT)
+        return self._client.publish(topic, payload, qos, retain)
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._client, name, value)
+
+
+def _records(f):
+    """ Iterate over the (ts, kind, topic, payload, end offset) of the complete records of f, after MAGIC"""
+    topics = {}
+    while True:
+        header = f.read(RECORD.size)
+        if len(header) < RECORD.size:
+            return
+        kind, ts, topic_id, length = RECORD.unpack(header)
+        if kind not in (TOPIC, RECEIVED, SENT) or (kind != TOPIC and topic_id not in topics):
+            return
+        data = f.read(length)
+        if len(data) < length:
+            return
+        if kind == TOPIC:
+            try:
+                topics[topic_id] = data.decode()
+            except UnicodeDecodeError:
+                return
+        yield ts, kind, topics[topic_id], data, f.tell()
+
+def read(path):
+    """ Iterate over the (ts, kind, topic, payload) of a trace file, records are read one by one"""
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(path + " is not a trace file")
+        for ts, kind, topic, data, end in _records(f):
+            if kind != TOPIC:
+                yield ts, kind, topic, data
+
+def valid_size(path):
+    """ Size of the complete records of a trace file (0 if it is not a trace file)"""
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            return 0
+        end = len(MAGIC)
+        for record in _records(f):
+            end = record[4]
+        return end
+
+def files(path):
+    """ Return the trace files of path, oldest first (rotated files included)"""
+    rotated = []
+    i = 1
+    while os.path.exists("{}.{}".format(path, i)):
+        rotated.append("{}.{}".format(path, i))
+        i += 1
+    rotated.reverse()
+    return rotated + ([path] if os.path.exists(path) else [])
+
+def read_all(path):
+    """ Iterate over the records of path and of its rotated files, oldest first"""
+    for name in files(path):
+        yield from read(name)
+
+def is_trace(path):
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def main():
+    for path in sys.argv[1:]:
+        for ts, kind, topic, payload in read(path):
+            print(json.dumps({'ts': ts, 'topic': topic, 'payload': payload.decode(errors='replace'),
+                              'sent': kind == SENT}))
+
+if __name__ == '__main__':
+    main()
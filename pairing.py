@@ -0,0 +1,78 @@
+# Copyright (C) 2020-2022 Coturex - F5RQG
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Pairing of the consumption and production readings by arrival date: evaluate() runs once per pair, when the second
+# reading arrives less than 'window' seconds after the first one, instead of once per message with a stale value of
+# the other meter.
+# - a reading which is not paired (replaced by the next reading of its meter, or too old when the other meter answers)
+#   is dropped
+# - a reading is evaluated alone when the other meter is silent for more than 'timeout' seconds (the regulation then
+#   handles the PZEM timeout), or when no pair was made for 'max_wait' seconds (window below the skew of the meters)
+
+import metrics
+
+CONSUMPTION = 0
+PRODUCTION = 1
+
+
+class SamplePairer:
+    def __init__(self, window, timeout, max_wait):
+        self.window = window
+        self.timeout = timeout
+        self.max_wait = max_wait
+        self.last_evaluation = None
+        self.pending = [None, None]     # arrival date of the reading waiting for its pair, by meter
+        self.last = [None, None]        # arrival date of the last reading, by meter
+        # statistics
+        self.pairs = 0
+        self.dropped = 0
+        self.unpaired = 0
+        self.skew_sum = 0.0
+        self.skew_max = 0.0
+
+    def offer(self, meter, ts):
+        """ A reading of meter (CONSUMPTION, PRODUCTION) arrived at ts, return True if evaluate() must run"""
+        other = 1 - meter
+        if self.pending[meter] is not None:
+            self.dropped += 1
+        self.pending[meter] = None
+        self.last[meter] = ts
+        waiting = self.pending[other]
+        if waiting is not None:
+            self.pending[other] = None
+            skew = ts - waiting
+            if skew <= self.window:
+                self.pairs += 1
+                self.skew_sum += skew
+                if skew > self.skew_max:
+                    self.skew_max = skew
+                metrics.record('pair_skew', skew)
+                self.last_evaluation = ts
+                return True
+            self.dropped += 1
+        if self.last[other] is None or ts - self.last[other] > self.timeout or \
+                (self.last_evaluation is not None and ts - self.last_evaluation > self.max_wait):
+            self.unpaired += 1
+            self.last_evaluation = ts
+            return True
+        self.pending[meter] = ts
+        return False
+
+    def stats(self):
+        return {
+            'pairs': self.pairs,
+            'dropped': self.dropped,
+            'unpaired': self.unpaired,
+            'skew_avg': round(self.skew_sum / self.pairs, 3) if self.pairs else None,
+            'skew_max': round(self.skew_max, 3),
+        }
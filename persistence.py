@@ -0,0 +1,216 @@
+#!/usr/bin/python3
+
+# Copyright (C) 2020-2022 Coturex - F5RQG
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Persistent counters of the regulation (status.ini): cloud forecast, energies, overload of the equipments.
+# - snapshot : status.ini, JSON, written to a temporary file, synced and renamed, a power cut leaves the old or the
+#   new file, never a partial one
+# - journal : status.ini.journal, one compact JSON line per save with the changed values only, appended and synced
+# The journal starts with the id of its snapshot, and is replaced by an empty one at each compaction (journal above
+# max_journal bytes, start and end of the program). A journal left by a previous snapshot (crash during a compaction,
+# status.ini copied from another host) is ignored, a torn last line (power cut during an append) is dropped.
+# State : {'CLOUD_forecast', 'ECS_energy_yesterday', 'production_energy', 'equipments': {name: {'energy', 'overed'}}}
+#
+# $> python3 persistence.py [status.ini]                 load time of a status
+# $> python3 persistence.py --simulate 1000              load time of a journal of 1000 saves, with a torn line
+
+import argparse, datetime, json, os, tempfile, time
+
+JOURNAL_SUFFIX = '.journal'
+
+
+class Store:
+    def __init__(self, path='status.ini', max_journal=65536):
+        self.path = path
+        self.journal_path = path + JOURNAL_SUFFIX
+        self.max_journal = max_journal
+        self.id = None
+        self.state = None           # last saved state
+        self.journal_size = 0
+        # statistics
+        self.records = 0            # journal lines applied by load()
+        self.torn = False           # load() dropped a partial line
+        self.load_time = 0
+        self.snapshots = 0
+        self.appends = 0
+        self.bytes_written = 0
+
+    def load(self):
+        """ Return the saved state (snapshot and its journal), None if there is no snapshot"""
+        start = time.perf_counter()
+        self.records = 0
+        self.torn = False
+        try:
+            with open(self.path) as f:
+                j = json.load(f)
+        except FileNotFoundError:
+            return None
+        # status.ini of the previous versions: equipments is a list, and there is no journal
+        state = {k: v for k, v in j.items() if k not in ('equipments', 'journal', 'date', 'date_str')}
+        state['equipments'] = {e['name']: {'energy': e['energy'], 'overed': e['overed']} for e in j['equipments']}
+        snapshot_id = j.get('journal')
+        if snapshot_id is not None:
+            try:
+                with open(self.journal_path, 'rb') as f:
+                    lines = f.read().split(b'\n')
+            except FileNotFoundError:
+                lines = []
+            if lines and _header(lines[0]) == snapshot_id:
+                for line in lines[1:]:
+                    if not line:
+                        continue
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        self.torn = True
+                        break
+                    apply(state, record)
+                    self.records += 1
+        self.load_time = time.perf_counter() - start
+        return state
+
+    def snapshot(self, state):
+        """ Write state in a new snapshot, and start its journal"""
+        snapshot_id = os.urandom(4).hex()
+        now = time.time()
+        doc = {k: v for k, v in state.items() if k != 'equipments'}
+        doc['equipments'] = [dict(e, name=name) for name, e in state['equipments'].items()]
+        doc['journal'] = snapshot_id
+        doc['date'] = int(now)
+        doc['date_str'] = datetime.datetime.fromtimestamp(now).strftime('%Y-%m-%d %H:%M:%S')
+        data = json.dumps(doc, indent=4, sort_keys=True)
+        write_atomic(self.path, data)
+        header = json.dumps({'journal': snapshot_id}) + '\n'
+        write_atomic(self.journal_path, header)
+        self.id = snapshot_id
+        self.state = copy(state)
+        self.journal_size = len(header)
+        self.snapshots += 1
+        self.bytes_written += len(data) + len(header)
+
+    def append(self, state):
+        """ Journal the changes of state since the previous save, compact when the journal is full"""
+        if self.id is None:
+            self.snapshot(state)
+            return
+        changes = diff(self.state, state)
+        if changes is None:
+            return
+        line = json.dumps(changes, separators=(',', ':')) + '\n'
+        if self.journal_size + len(line) > self.max_journal:
+            self.snapshot(state)
+            return
+        with open(self.journal_path, 'a') as f:
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+        apply(self.state, changes)
+        self.journal_size += len(line)
+        self.appends += 1
+        self.bytes_written += len(line)
+
+    def stats(self):
+        return {'snapshots': self.snapshots, 'appends': self.appends, 'bytes_written': self.bytes_written,
+                'journal_size': self.journal_size}
+
+
+def _header(line):
+    try:
+        return json.loads(line).get('journal')
+    except (ValueError, AttributeError):
+        return None
+
+def copy(state):
+    c = dict(state)
+    c['equipments'] = {name: dict(e) for name, e in state['equipments'].items()}
+    return c
+
+def diff(old, new):
+    """ Values of new that differ from old, None if there is no change"""
+    changes = {k: v for k, v in new.items() if k != 'equipments' and old.get(k) != v}
+    equipments = {}
+    for name, e in new['equipments'].items():
+        previous = old['equipments'].get(name, {})
+        changed = {k: v for k, v in e.items() if previous.get(k) != v}
+        if changed:
+            equipments[name] = changed
+    if equipments:
+        changes['equipments'] = equipments
+    return changes or None
+
+def apply(state, changes):
+    for k, v in changes.items():
+        if k == 'equipments':
+            for name, e in v.items():
+                state['equipments'].setdefault(name, {}).update(e)
+        else:
+            state[k] = v
+
+def write_atomic(path, data):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+    except OSError:
+        pass
+
+def simulate(saves):
+    """ Journal saves states in a temporary directory, tear the last line, and time load()"""
+    with tempfile.TemporaryDirectory() as d:
+        store = Store(os.path.join(d, 'status.ini'), max_journal=1 << 30)
+        state = {'CLOUD_forecast': 40, 'ECS_energy_yesterday': 3200, 'production_energy': 0,
+                 'equipments': {'ecs': {'energy': 0, 'overed': False}, 'heater': {'energy': 0, 'overed': False}}}
+        start = time.perf_counter()
+        for i in range(saves):
+            state['production_energy'] += 25
+            state['equipments']['ecs']['energy'] += 10
+            store.append(state)
+        elapsed = time.perf_counter() - start
+        with open(store.journal_path, 'a') as f:
+            f.write('{"production_ener')
+        loaded = Store(store.path)
+        result = loaded.load()
+        assert result['production_energy'] == state['production_energy'] and loaded.torn
+        print("{} saves : {:.0f} us per save (with fsync), journal {} bytes, {} bytes written".format(
+            saves, elapsed * 1e6 / saves, store.journal_size, store.bytes_written))
+        print("load : {:.2f} ms, {} journal records applied, torn line dropped".format(loaded.load_time * 1000,
+                                                                                      loaded.records))
+
+def main():
+    parser = argparse.ArgumentParser(description="load time of the persistent status")
+    parser.add_argument('path', nargs='?', default='status.ini')
+    parser.add_argument('--simulate', type=int, metavar='SAVES', help="time a journal of SAVES saves")
+    args = parser.parse_args()
+    if args.simulate:
+        simulate(args.simulate)
+        return
+    store = Store(args.path)
+    state = store.load()
+    if state is None:
+        print("no " + args.path)
+        return
+    print("load : {:.2f} ms, {} journal records applied{}".format(store.load_time * 1000, store.records,
+                                                                  ", torn line dropped" if store.torn else ''))
+    print(json.dumps(state, indent=2))
+
+if __name__ == '__main__':
+    main()
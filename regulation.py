@@ -34,21 +34,31 @@
 
 # See the "equipment module" for the definitions of the loads.
 
-import signal, sys, os, psutil, datetime, json, time
-import paho.mqtt.client as mqtt
+import signal, sys, os, socket, datetime, json, time, threading, functools
+from concurrent.futures import ThreadPoolExecutor
 
 from debug_log import log as log
 from debug_log import debug as debug
 
 import cloud_prediction
-from cloud_prediction import TOMORROW, Prediction
+from cloud_prediction import TODAY, TOMORROW, Prediction
 
 import equipment
 from equipment import ConstantPowerEquipment, VariablePowerEquipment
-
-import configparser
-config = configparser.ConfigParser()
-config.read('config.ini')
+import allocation
+from controller import StepResponse, ConsumptionPredictor
+from scheduler import FixedRateScheduler
+from status_publisher import StatusPublisher
+import persistence
+from domoticz import DomoticzOutput
+import filters
+import pairing
+import energy_history
+import clock
+import mqtt_trace
+import metrics
+
+from libccx import config
 
 unset_words = ("none", "None", "NONE", "false", "False", "FALSE", "nok", "NOK")
 set_words = ("true", "True", "TRUE", "ok", "OK", )
@@ -75,21 +85,54 @@ if (config['debug']['simulation'] in set_words):
             SIM_FALLBACK = True
             print("     FALLBACK IS SIMULATED ")
         #input("Enter to continue")
-        time.sleep(2)
+        clock.sleep(2)
 
 if (config['debug']['regulation_stdout'] in set_words): 
     SDEBUG = True 
 else: SDEBUG = False
 
-last_grid = None
-last_injection = None
+# MQTT trace of the received and published messages (see mqtt_trace.py), rotated every trace_size MB
+try:
+    TRACE_FILE = config['debug']['trace_file']
+    if TRACE_FILE in unset_words:
+        TRACE_FILE = None
+except Exception:
+    TRACE_FILE = None
+TRACE_SIZE = int(config['debug'].get('trace_size', '10'))
+TRACE_COUNT = int(config['debug'].get('trace_count', '5'))
+recorder = None
+
+# Energy history by minute, hour and day (see energy_history.py), in a memory mapped file, none to disable
+try:
+    HISTORY_FILE = config['history']['file']
+    if HISTORY_FILE in unset_words:
+        HISTORY_FILE = None
+except Exception:
+    HISTORY_FILE = None
+try:
+    HISTORY_SIZES = tuple(int(config['history'][k]) for k in ('minutes', 'hours', 'days'))
+except Exception:
+    HISTORY_SIZES = (2880, 24 * 62, 3660)
+history = None
+
+# Hot path metrics (see metrics.py), published every 'period' seconds on TOPIC_STATUS/metrics (0 to disable) and
+# written to a Prometheus text file
+try:
+    METRICS_PERIOD = int(config['metrics']['period'])
+except Exception:
+    METRICS_PERIOD = 0
+try:
+    METRICS_FILE = config['metrics']['prometheus_file']
+    if METRICS_FILE in unset_words:
+        METRICS_FILE = None
+except Exception:
+    METRICS_FILE = None
+metrics.enable(METRICS_PERIOD > 0)
+last_metrics_date = None
+
 last_evaluation_date = None
 last_production_date = None
 last_consumption_date = None
-last_grid_date = 0
-last_injection_date = 0
-last_zero_grid_date = 0
-last_zero_injection_date = 0
 last_saveStatus_date = None
 
 fallback_today = False
@@ -100,6 +143,14 @@ power_consumption = None
 status = None
 equipments = ()
 equipment_water_heater = None
+equipments_by_name = {}
+# static arrays of the equipments used by the allocation engine, same order as the equipments list
+equipments_min_power = ()
+equipments_max_power = ()
+equipments_constant = ()
+controllers = False
+topic_handlers = {}
+topic_filters = {}
 
 ECS_energy_yesterday = 0
 ECS_energy_today = 0
@@ -108,6 +159,19 @@ CLOUD_forecast = None
 ECS_MODE = 20     # set to Domoticz value 20 wich is SOLAIRE_FEEDBACK widget level
 
 PZEM_TIMEOUT = 30
+
+# sample_lock protects the latest measurements written by the MQTT thread, control_lock serializes the equipments
+# commands between the MQTT thread (force/unforce) and the control thread when the scheduler is used
+sample_lock = threading.Lock()
+control_lock = threading.RLock()
+scheduler = None
+
+# Slow jobs (weather forecast, Domoticz round-trips) run on this worker pool. The regulation keeps on balancing while
+# they are pending, their result is applied by evaluate() once the future is done.
+workers = ThreadPoolExecutor(max_workers=2, thread_name_prefix="worker")
+fallback_job = None
+ecs_mode_event = threading.Event()
+ECS_MODE_TIMEOUT = 5
 weather = Prediction(config['cloudForecast']['location'],config['cloudForecast']['key'])
 
 ###############################################################
@@ -116,11 +180,37 @@ mqtt_client = None
 prefix = 'simu/' if SIMULATION else ''
 MQTT_BROKER = config['mqtt']['broker_ip'] 
 PORT = int(config['mqtt']['port'])
+BROKER_PROBE_PERIOD = 5
+try:
+    BROKER_WAIT = float(config['mqtt']['broker_wait'])
+except Exception:
+    BROKER_WAIT = 60
 TOPIC_SENSOR_CONSUMPTION =  config['mqtt']['topic_cons'] 
 TOPIC_SENSOR_PRODUCTION = config['mqtt']['topic_prod'] 
 TOPIC_REGULATION = prefix + config['mqtt']['topic_regul'] 
 TOPIC_FORCE = prefix + config['mqtt']['topic_force'] # forced/unforced duration - Can be bind to domotics device topic 
 TOPIC_STATUS = prefix + config['mqtt']['topic_status']
+TOPIC_METRICS = TOPIC_STATUS + '/metrics'
+# Status publications (see status_publisher.py): at most one every status_interval seconds, and with status_delta only
+# the changed fields between the full status sent every status_full seconds
+try:
+    STATUS_INTERVAL = float(config['mqtt']['status_interval'])
+except Exception:
+    STATUS_INTERVAL = 0
+try:
+    STATUS_FULL = float(config['mqtt']['status_full'])
+except Exception:
+    STATUS_FULL = 60
+try:
+    STATUS_DELTA = config['mqtt']['status_delta'] in set_words
+except Exception:
+    STATUS_DELTA = False
+try:
+    STATUS_COMPACT = config['mqtt']['status_compact'] in set_words
+except Exception:
+    STATUS_COMPACT = False
+status_publisher = StatusPublisher(TOPIC_STATUS, STATUS_INTERVAL, STATUS_FULL, STATUS_DELTA, STATUS_COMPACT)
+evaluations = 0
 TOPIC_ECSMODE = config['mqtt']['topic_ecsMode']
 print (TOPIC_ECSMODE)
 
@@ -140,6 +230,24 @@ else: SEND_INJECTION = False
 if (config['domoticz']['send_grid'] in set_words): 
     SEND_GRID = True 
 else: SEND_GRID = False
+# Grid / injection devices (see domoticz.py) : non zero values averaged over 'period' seconds and sent if they moved by
+# 'deadband' W, a 0 before a value following 'zero_anchor' seconds of zero, at most 'queue_size' messages kept while
+# the broker is unreachable
+try:
+    DOMOTICZ_PERIOD = float(config['domoticz']['period'])
+except Exception:
+    DOMOTICZ_PERIOD = 0
+try:
+    DOMOTICZ_DEADBAND = int(config['domoticz']['deadband'])
+except Exception:
+    DOMOTICZ_DEADBAND = 0
+try:
+    DOMOTICZ_QUEUE = int(config['domoticz']['queue_size'])
+except Exception:
+    DOMOTICZ_QUEUE = 100
+domoticz_out = DomoticzOutput(TOPIC_DOMOTICZ_IN, DOMOTICZ_PERIOD, DOMOTICZ_DEADBAND, queue_size=DOMOTICZ_QUEUE)
+domoticz_out.add('injection', IDX_INJECTION)
+domoticz_out.add('grid', IDX_GRID, keepalive=1800)     # a keepalive for Domoticz
 
 ###############################################################
 # EVELUATION CONFIG
@@ -151,7 +259,49 @@ BALANCE_THRESHOLD = int(config['evaluate']['balance_threshold'])
 # Keep this margin (in watts) between the power production and consumption. This helps in reducing grid consumption
 # knowing that there may be measurement inaccuracy.
 MARGIN = int(config['evaluate']['margin'])
+# With the scheduler set, evaluate() runs in a dedicated control thread every EVALUATION_PERIOD seconds and the MQTT
+# messages only refresh the latest measurements. Otherwise evaluate() is called by each sensor message.
+try:
+    SCHEDULER = config['evaluate']['scheduler'] in set_words
+except Exception:
+    SCHEDULER = False
+EVALUATE_ON_MESSAGE = not SCHEDULER
+# Selection of the constant equipments to turn on : 'greedy' by priority order, or 'knapsack' (best fit of the surplus)
+try:
+    KNAPSACK = config['evaluate']['constant_selection'] == 'knapsack'
+except Exception:
+    KNAPSACK = False
+# evaluate() also runs the keep-alive, INIT_AT, CHECK_AT and status saving jobs, unless an external timer does it
+EVALUATE_CLOCK_JOBS = True
 STATUS_TIME = int(config['evaluate']['status_time']) 
+# status.ini : the counters are journaled every STATUS_TIME seconds, the snapshot is rewritten when the journal reaches
+# status_journal_size KB (see persistence.py)
+try:
+    JOURNAL_SIZE = int(config['evaluate']['status_journal_size']) * 1024
+except Exception:
+    JOURNAL_SIZE = 64 * 1024
+store = persistence.Store('status.ini', JOURNAL_SIZE)
+# Overshoot and settling time of the power balance after a step, to compare the control modes (raw / pi)
+step_response = StepResponse(BALANCE_THRESHOLD)
+# Prediction of the consumption between two readings : the last reading plus the power commanded less than
+# 'predict_settle' seconds before it (see controller.py), so that an evaluation does not react again to a reading
+# which does not include the previous commands yet
+try:
+    PREDICT = config['evaluate']['predict'] in set_words
+except Exception:
+    PREDICT = False
+try:
+    PREDICT_SETTLE = float(config['evaluate']['predict_settle'])
+except Exception:
+    PREDICT_SETTLE = 1.5
+predictor = ConsumptionPredictor(PREDICT_SETTLE) if PREDICT else None
+# Evaluation on message : once per pair of consumption / production readings arrived less than pair_window seconds
+# apart (see pairing.py), 0 to evaluate on each reading
+try:
+    PAIR_WINDOW = float(config['evaluate']['pair_window'])
+except Exception:
+    PAIR_WINDOW = 0
+pairer = pairing.SamplePairer(PAIR_WINDOW, PZEM_TIMEOUT, 2 * EVALUATION_PERIOD) if PAIR_WINDOW > 0 else None
 CHECK_AT = int(config['evaluate']['check_at']) 
 if (CHECK_AT == 0 or CHECK_AT >= 24):
     CHECK_AT = 0
@@ -174,125 +324,140 @@ else:
 
 ###############################################################
 # FUNCTIONS
-def checkProcessRunning(processName):
-    # Checking if there is any running process that contains the given name processName.
-    #Iterate over the all the running process
-    for proc in psutil.process_iter():
+def wait_broker(timeout=BROKER_WAIT, period=BROKER_PROBE_PERIOD):
+    # The broker may not be ready yet (mosquitto starting on the same host): probe its port until it accepts a connection,
+    # for at most timeout seconds (a wrong broker_ip ends the program)
+    deadline = time.monotonic() + timeout
+    waiting = False
+    while True:
         try:
-            # Check if process name contains the given name string.
-            if processName.lower() in proc.name().lower():
-                return True
-        except (psutil.NoSuchProcess, psutil.AccessDenied, psutil.ZombieProcess):
-            pass
-    return False;
+            socket.create_connection((MQTT_BROKER, PORT), timeout=period).close()
+            if waiting:
+                log(0, "[Main] broker " + MQTT_BROKER + " ready")
+            return
+        except OSError as e:
+            if time.monotonic() + period > deadline:
+                print("Cannot connect " + MQTT_BROKER + " : " + str(e))
+                log(0, "[Main] *** broker " + MQTT_BROKER + " not ready after " + str(timeout) + "s : " + str(e))
+                sys.exit(1)
+            if not waiting:
+                log(0, "[Main] waiting for broker " + MQTT_BROKER + " : " + str(e))
+                waiting = True
+            time.sleep(period)
 
 def now_ts():
-    return time.time()
+    return clock.now_ts()
+
+def init_trace(client):
+    """ Return the client to publish with: a recording proxy of client when trace_file is set"""
+    global recorder
+    if TRACE_FILE is None:
+        return client
+    recorder = mqtt_trace.Recorder(TRACE_FILE, TRACE_SIZE * 1000000, TRACE_COUNT)
+    log(0, "[Main] MQTT trace : " + TRACE_FILE)
+    return mqtt_trace.TracedClient(client, recorder)
+
+def init_history():
+    """ Open the energy history, its columns are the equipments"""
+    global history
+    if HISTORY_FILE is None:
+        return
+    history = energy_history.EnergyHistory(HISTORY_FILE, [e.name for e in equipments], *HISTORY_SIZES,
+                                           max_gap=PZEM_TIMEOUT)
+    log(0, "[Main] energy history : " + HISTORY_FILE + (" (created)" if history.recreated else ""))
+
+def get_measurements():
+    """ Return a consistent snapshot of the latest power measurements and their dates"""
+    with sample_lock:
+        return power_consumption, power_production, last_consumption_date, last_production_date
+
+def control_tick():
+    # Scheduler task, run in the control thread
+    with control_lock:
+        evaluate()
 
 def get_equipment_by_name(name):
-    for e in equipments:
-        if e.name == name:
-            return e
-    return None
+    return equipments_by_name.get(name)
 
 def on_connect(client, userdata, flags, rc):
     debug(0, "Connected to BROKER " + MQTT_BROKER )
-    debug(1, "Subscribing " + TOPIC_SENSOR_CONSUMPTION)
-    debug(1, "Subscribing " + TOPIC_SENSOR_PRODUCTION)
-    debug(1, "Subscribing " + TOPIC_ECSMODE)
-    #debug(1, "Subscribing " + TOPIC_REGULATION_MODE)
-    client.subscribe(TOPIC_SENSOR_CONSUMPTION)
-    client.subscribe(TOPIC_SENSOR_PRODUCTION)
-    client.subscribe(TOPIC_ECSMODE)
-    client.subscribe("smeter/pzem/ECS")
-    if(TOPIC_FORCE not in unset_words):
-        debug(1, "Subscribing " + TOPIC_FORCE)
-    global equipments
+    for topic in topic_handlers:
+        debug(1, "Subscribing " + topic)
+    client.subscribe([(topic, 0) for topic in topic_handlers])
+
+def init_topic_handlers():
+    """ Build the topic -> handler table used by on_message, its keys are the subscribed topics"""
+    global topic_handlers
+    topic_handlers = {
+        TOPIC_SENSOR_CONSUMPTION: on_consumption,
+        TOPIC_SENSOR_PRODUCTION: on_production,
+        TOPIC_ECSMODE: on_ecs_mode,
+    }
+    if config['mqtt']['topic_force'] not in unset_words:
+        topic_handlers[TOPIC_FORCE] = on_force
+    # topic_read_power messages : which equipment is 'over loaded' ? (a topic may be shared by several equipments)
+    readers = {}
     for e in equipments:
-        if (e.topic_read_power != None):
-            debug(1, "Subscribing " + str(e.topic_read_power))
+        if e.topic_read_power is not None:
+            readers.setdefault(e.topic_read_power, []).append(e)
+    for topic, eqs in readers.items():
+        topic_handlers[topic] = functools.partial(on_read_power, tuple(eqs))
+    init_filters()
+
+def init_filters():
+    """ Build the topic -> ((json key, filter chain), ...) table of the power readings ([filters] section, see
+    filters.py) : 'power' of the sensor topics, json_read_power of the equipments on their topic_read_power"""
+    global topic_filters
+    topic_filters = {}
+    if not config.has_section('filters'):
+        return
+    aliases = {'consumption': TOPIC_SENSOR_CONSUMPTION, 'production': TOPIC_SENSOR_PRODUCTION}
+    read_keys = {TOPIC_SENSOR_CONSUMPTION: ['power'], TOPIC_SENSOR_PRODUCTION: ['power']}
+    for e in equipments:
+        if e.topic_read_power is not None and e.json_read_power is not None:
+            keys = read_keys.setdefault(e.topic_read_power, [])
+            if e.json_read_power not in keys:
+                keys.append(e.json_read_power)
+    # the keys of config.ini are lower case
+    topics = {topic.lower(): topic for topic in read_keys}
+    for key, spec in config['filters'].items():
+        topic = aliases.get(key, topics.get(key))
+        if topic is None:
+            log(0, "[filters] '{}' is not a power reading topic (sensors, topic_read_power), ignored".format(key))
+            continue
+        try:
+            # one chain per json key, the equipments sharing a topic may read different keys
+            topic_filters[topic] = tuple((k, filters.parse(spec)) for k in read_keys[topic])
+            log(0, "[filters] {} ({}) : {}".format(topic, ', '.join(read_keys[topic]), spec))
+        except ValueError as e:
+            log(0, "[filters] {} : {}".format(key, e))
 
 def on_message(client, userdata, msg):
     # Receive power consumption and production values and triggers the evaluation. We also take into account manual
     # control messages in case we want to turn on/off a given equipment.
-    global power_production, power_consumption, last_production_date, last_consumption_date, production_energy
-    global PZEM_TIMEOUT, ECS_MODE
-
     print("[on message] topic : " + msg.topic) if SDEBUG else ''
+    if recorder is not None:
+        recorder.record(msg.topic, msg.payload)
+    metrics.count(msg.topic)
+    handler = topic_handlers.get(msg.topic)
+    if handler is None:
+        return
     now = now_ts()
+    j = None
     try:
-        ##########
-        # TOPIC DETECTED IS : CONSUMTION
-        if msg.topic == TOPIC_SENSOR_CONSUMPTION:
-            print("[on message]         conso : " + str(power_consumption) + ", prod : " + str(power_production)) if SDEBUG else ''
-            j = json.loads(msg.payload.decode())
-            power_consumption = int(j['power'])
-            evaluate()
-            last_consumption_date = now
-        ##########
-        # TOPIC DETECTED IS : PRODUCTION
-        elif msg.topic == TOPIC_SENSOR_PRODUCTION:
-            print("[on message]         conso : " + str(power_consumption) + ", prod : " + str(power_production)) if SDEBUG else ''
-            j = json.loads(msg.payload.decode())
-            power_production = int(j['power'])
-            if last_production_date is not None:
-                delta = now - last_production_date
-                if delta < PZEM_TIMEOUT:
-                    production_energy += power_production * delta / 3600.0
-            if SIMULATION and SIM_PROD is not None:
-                power_production = SIM_PROD
-            evaluate()
-            last_production_date = now
-        ##########
-        # TOPIC DETECTED IS : ECS_MODE
-        elif msg.topic == TOPIC_ECSMODE :
-            j = json.loads(msg.payload.decode())
-            ECS_MODE = int(j['svalue1'])
-            print("[on message]         ********************************** ECS_MODE : " + str(ECS_MODE)) if SDEBUG else ''
-        ##########
-        # TOPIC DETECTED IS : FORCE
-        elif msg.topic == TOPIC_FORCE: 
-            print("[on message]         Forcing...") if SDEBUG else ''
-            j = json.loads(msg.payload.decode())
-            command = j['command']
-            name = j['name']
-            if command == 'force':
-                e = get_equipment_by_name(name)
-                if e:
-                    power = j['power']
-                    msg = 'forcing equipment {} to {}W'.format(name, power)
-                    duration = j.get('duration')  # duration is optional with default value None
-                    if duration:
-                        msg += ' for '+str(duration)+' seconds'
-                    else:
-                        msg += ' without time limitation'
-                    debug(0, '')
-                    debug(0, msg)
-                    e.force(power, duration)
-                    evaluate()
-            elif command == 'unforce':
-                e = get_equipment_by_name(name)
-                if e:
-                    debug(0, '')
-                    debug(0, 'not forcing equipment {} anymore'.format(name))
-                    e.force(None)
-                    evaluate()
-
-        ##########
-        # TOPIC DETECTED IS : unknown        
-        else: # This is a topic_read_power msg. Which equipment is 'over loaded'  ?
-            for e in equipments:
-                print("    Equipment : " + e.name)      if SDEBUG else ''   
-                print("        topic_read_power : '" + str(e.topic_read_power)+"'") if SDEBUG else ''   
-                print("        is_overed : " + str(e.is_overed()))      if SDEBUG else ''   
-                
-                if (e.topic_read_power is not None) and (not e.is_overed()):
-                    if (msg.topic == e.topic_read_power):
-                        print("            "+ e.name + " check over") if SDEBUG else ''
-                        j = json.loads(msg.payload.decode())
-                        e.measured_power = int(j[e.json_read_power])
+        start = time.perf_counter()
+        j = json.loads(msg.payload.decode())
+        metrics.observe('decode', start)
+        chains = topic_filters.get(msg.topic)
+        if chains is not None:
+            start = time.perf_counter()
+            for key, chain in chains:
+                if key in j:
+                    j[key] = round(chain.filter(float(j[key])))
+            metrics.observe('filter', start)
+        handler(j, now)
     except Exception as e:
-        if 'PZEM_READ_ERROR' in j:
+        if j is not None and 'PZEM_READ_ERROR' in j:
             print("************* [on message]         pzem error") if SDEBUG else ''
         else :
             log(1, "*** Error on line {}".format(sys.exc_info()[-1].tb_lineno))
@@ -303,6 +468,78 @@ def on_message(client, userdata, msg):
             print(e) if SDEBUG else ''
             print(j) if SDEBUG else ''
 
+def on_consumption(j, now):
+    global power_consumption, last_consumption_date
+    print("[on message]         conso : " + str(power_consumption) + ", prod : " + str(power_production)) if SDEBUG else ''
+    with sample_lock:
+        power_consumption = int(j['power'])
+        last_consumption_date = now
+    if EVALUATE_ON_MESSAGE:
+        if pairer is None or pairer.offer(pairing.CONSUMPTION, now):
+            evaluate()
+
+def on_production(j, now):
+    global power_production, last_production_date, production_energy
+    print("[on message]         conso : " + str(power_consumption) + ", prod : " + str(power_production)) if SDEBUG else ''
+    with sample_lock:
+        power_production = int(j['power'])
+        if last_production_date is not None:
+            delta = now - last_production_date
+            if delta < PZEM_TIMEOUT:
+                production_energy += power_production * delta / 3600.0
+        if SIMULATION and SIM_PROD is not None:
+            power_production = SIM_PROD
+        last_production_date = now
+    if EVALUATE_ON_MESSAGE:
+        if pairer is None or pairer.offer(pairing.PRODUCTION, now):
+            evaluate()
+
+def on_ecs_mode(j, now):
+    global ECS_MODE
+    ECS_MODE = int(j['svalue1'])
+    print("[on message]         ********************************** ECS_MODE : " + str(ECS_MODE)) if SDEBUG else ''
+    ecs_mode_event.set()
+
+def on_force(j, now):
+    print("[on message]         Forcing...") if SDEBUG else ''
+    command = j['command']
+    name = j['name']
+    if command == 'force':
+        e = get_equipment_by_name(name)
+        if e:
+            power = j['power']
+            msg = 'forcing equipment {} to {}W'.format(name, power)
+            duration = j.get('duration')  # duration is optional with default value None
+            if duration:
+                msg += ' for '+str(duration)+' seconds'
+            else:
+                msg += ' without time limitation'
+            debug(0, '')
+            debug(0, msg)
+            with control_lock:
+                e.force(power, duration)
+            if EVALUATE_ON_MESSAGE:
+                evaluate()
+    elif command == 'unforce':
+        e = get_equipment_by_name(name)
+        if e:
+            debug(0, '')
+            debug(0, 'not forcing equipment {} anymore'.format(name))
+            with control_lock:
+                e.force(None)
+            if EVALUATE_ON_MESSAGE:
+                evaluate()
+
+def on_read_power(eqs, j, now):
+    for e in eqs:
+        if not e.is_overed():
+            print("            "+ e.name + " check over") if SDEBUG else ''
+            e.measured_power = int(j[e.json_read_power])
+            e.measured_new = True
+            if e.measured_date is not None:
+                e.read_period = now - e.measured_date
+            e.measured_date = now
+
 def signal_handler(sig, frame):
     """ End of program handler, set equipments 0W and save status"""
     global equipments, status
@@ -320,12 +557,22 @@ def signal_handler(sig, frame):
             signal_name = 'SIGBUS'
         print ("!! Received end signal : " + signal_name)
         log(0, "[signal_handler] !! Received end signal : " + signal_name)
+        if scheduler is not None:
+            scheduler.stop(5)
+            log(2, "scheduler : " + str(scheduler.stats()))
+        workers.shutdown(wait=False, cancel_futures=True)
+        # the signal may interrupt evaluate() on this thread: close its command cycle, the 0W are sent at once
+        equipment.end_cycle()
         for e in equipments:
             e.set_current_power(0) 
             log(2, e.name + " : set power to 0") 
         time.sleep(2)
         log(4, "[saveStatus] saving status")
-        saveStatus() if (config['debug']['use_persistent'] in set_words) else ''
+        saveStatus(True) if (config['debug']['use_persistent'] in set_words) else ''
+        if recorder is not None:
+            recorder.close()
+        if history is not None:
+            history.flush()
         log(0, "Bye")
         exit(0) 
     else:
@@ -335,8 +582,10 @@ def loadStatus():
     global status, ECS_energy_today, ECS_energy_yesterday, CLOUD_forecast, production_energy, equipments
     log(0, "[loadStatus] loading status")
     try:
-        statusFile = open('status.ini')
-        j = json.load(statusFile)
+        j = store.load()
+        if j is None:
+            log(2, "no status.ini")
+            return
         CLOUD_forecast = j['CLOUD_forecast']
         if CLOUD_forecast == 'null':
             CLOUD_forecast = None
@@ -346,34 +595,57 @@ def loadStatus():
         log(2,"CLOUD_forecast : " + str(CLOUD_forecast))
         log(2,"ECS_energy_yesterday : " + str(ECS_energy_yesterday))
         log(2,"production_energy : " + str(production_energy))
-        i =0
+        saved = j['equipments']
         for e in equipments:
+            s = saved.get(e.name)
+            if s is None:
+                continue
             log(0, "loading " + e.name )
-            for i in range(len(j['equipments'])):
-                if (e.name == j['equipments'][i]['name']):
-                    #log(4, " find ; " + j['equipments'][i]['name']) 
-                    nrj = int(j['equipments'][i]['energy'])
-                    log(4, "read energy : " + str(nrj)) 
-                    e.set_energy(nrj) 
-                    over = j['equipments'][i]['overed']
-                    if (over):
-                        log(4, "read overloaded : " + str(over))
-                        e.set_over()
-                    else:
-                        e.unset_over()    
+            nrj = int(s['energy'])
+            log(4, "read energy : " + str(nrj)) 
+            e.set_energy(nrj) 
+            over = s['overed']
+            if (over):
+                log(4, "read overloaded : " + str(over))
+                e.set_over()
+            else:
+                e.unset_over()    
+        log(2, "status loaded in %.1f ms, %d journal records%s", store.load_time * 1000, store.records,
+            " (torn line dropped)" if store.torn else "")
     
     except Exception as e:
         log(1, "*** Error on line {}".format(sys.exc_info()[-1].tb_lineno))
         log(1, e)
         log(2, "cannot load status.ini")
   
-def saveStatus():
+def persisted_state():
+    """ Counters saved in status.ini"""
+    return {
+        'CLOUD_forecast': CLOUD_forecast,
+        'ECS_energy_yesterday': int(ECS_energy_yesterday),
+        'production_energy': round(production_energy),
+        'equipments': {e.name: {'energy': int(e.get_energy()), 'overed': e.is_overed()} for e in equipments},
+    }
+
+def compactStatus():
+    """ Compaction of status.ini at start of the daemon, after loadStatus() : a new snapshot and an empty journal.
+    loadStatus() only reads, a tool loading the status does not touch the files of a running daemon"""
+    try:
+        store.snapshot(persisted_state())
+    except Exception as e:
+        log(1, "*** Error on line {}".format(sys.exc_info()[-1].tb_lineno))
+        log(1, e)
+        log(2, "cannot compact status.ini")
+
+def saveStatus(snapshot=False):
+    """ Journal the counters that changed, or write a new snapshot (end of program)"""
     global status
     if status is not None:
         try:
-            with open('status.ini', 'w') as statusFile:
-               json.dump(status, statusFile, indent=4, sort_keys=True)
-            statusFile.close()
+            if snapshot:
+                store.snapshot(persisted_state())
+            else:
+                store.append(persisted_state())
         except Exception as e:
             log(1, "*** Error on line {}".format(sys.exc_info()[-1].tb_lineno))
             log(1, e)
@@ -381,7 +653,7 @@ def saveStatus():
 
 def get_season():
     # get the current Day Of the Year
-    doy = datetime.date.today().timetuple().tm_yday
+    doy = datetime.date.fromtimestamp(now_ts()).timetuple().tm_yday
     
     try:
         # "day of year" ranges for my solar usage cf https://miniwebtool.com/day-of-year-calendar/
@@ -431,6 +703,86 @@ def send_keep_alive():  # domoticz request : does ECS is Jour/Nuit, Solaire_fall
     #print("###################################################################" + TOPIC_DOMOTICZ_IN + domoticz)
     
 
+def fetch_cloud_forecast():
+    """ Worker job: return the cloud forecast (percent), 100 if the weather server cannot give it"""
+    forecast = -1
+    retry = 0
+    while forecast < 0 and retry < 5:
+        if retry > 0:
+            clock.sleep(5) # Delays for 5 seconds
+        log(0,"[fetch_cloud_forecast] Cloud request : " + str(retry))
+        retry = retry + 1
+        if (CHECK_AT > 7 and CHECK_AT < 24):
+            log(0,"[fetch_cloud_forecast] Cloud Forecast Tomorrow")
+            forecast = weather.getCloudAvg(TOMORROW)
+        elif (CHECK_AT >= 0):
+            log(0,"[fetch_cloud_forecast] Cloud Forecast Today")
+            forecast = weather.getCloudAvg(TODAY)
+    log(0,"[fetch_cloud_forecast] Cloud forcast : " + str(forecast))
+    if (forecast == -404):
+        log(0,"*** cannot contact weather server")
+        log(4,"FORCING CLOUD Forecast to 100 %")  
+        forecast = 100 
+    elif (forecast == -1):
+        log(0,"*** cloudForecast is out of range")
+        log(4,"FORCING CLOUD Forecast to 100 %")   
+        forecast = 100 
+    return forecast
+
+def fetch_ECS_mode():
+    """ Worker job: request the ECS mode to Domoticz and wait for the answer, ECS_MODE is set by on_message"""
+    ecs_mode_event.clear()
+    request_ECS_mode()
+    if not ecs_mode_event.wait(ECS_MODE_TIMEOUT):
+        log(2, "no ECS_MODE answer from Domoticz, keeping " + str(ECS_MODE))
+    return ECS_MODE
+
+def prepare_fallback(with_forecast=True):
+    """ Worker job: gather the cloud forecast and the ECS mode needed by low_energy_fallback()"""
+    forecast = fetch_cloud_forecast() if with_forecast else CLOUD_forecast
+    fetch_ECS_mode()
+    return forecast
+
+def poll_fallback():
+    """ Apply the low energy fallback once its worker job is done, called from the regulation loop"""
+    global fallback_job, CLOUD_forecast
+    if fallback_job is None or not fallback_job.done():
+        return
+    job = fallback_job
+    fallback_job = None
+    try:
+        CLOUD_forecast = job.result()
+    except Exception as e:
+        log(0,"[poll_fallback] fallback job failed")
+        log(1, e)
+        log(4,"FORCING CLOUD Forecast to 100 %")
+        CLOUD_forecast = 100
+    # ensure that water stays warm enough
+    low_energy_fallback()
+
+def daily_init():
+    """ INIT_AT job: start a new solar day for the water heater"""
+    global fallback_today, init_today
+    log(0,"[daily_init] ECS energy / Over : " + str(equipment_water_heater.get_energy()) + " / " + str(equipment_water_heater.is_overed()))
+    equipment_water_heater.unset_over() # maybe it has been forced this night (low_energy_fallback)
+    equipment_water_heater.reset_energy()
+    log(0,"             ECS energy / Over : " + str(equipment_water_heater.get_energy()) + " / " + str(equipment_water_heater.is_overed()))
+    fallback_today = False
+    init_today = True
+
+def daily_check():
+    """ CHECK_AT job: close the solar day, low_energy_fallback() must follow once the forecast is known"""
+    global fallback_today, init_today, ECS_energy_today, production_energy
+    fallback_today = True
+    log(0,"------------------------------------------------------------")
+    log(0,"[daily_check] Past Cloud / Production / Water_heater")
+    log(8, "csv : {} ; {} ; {}".format(CLOUD_forecast, int(production_energy), ECS_energy_today) )
+    ECS_energy_today = equipment_water_heater.get_energy()
+    equipment_water_heater.reset_energy()
+    with sample_lock:
+        production_energy = 0
+    init_today = False
+
 def low_energy_fallback():
     """ Fallback, when the amount of energy today went below a minimum"""
     # This is a custom and very specific fallback method which aim is to turn on the water heater should the daily
@@ -471,8 +823,6 @@ def low_energy_fallback():
     log(2, 'ECS Energy Today : {}'.format(str(int(ECS_energy_today))))
     log(2, 'ECS Energy Yesterday : {}'.format(str(int(ECS_energy_yesterday))))
     log(2, 'ECS Energy Two days : {}'.format(str(int(two_days_nrj))))
-    request_ECS_mode()
-    time.sleep(5)
     log(2, "ECS_MODE : " + str(ECS_MODE))
 
     if (config['cloudForecast'][season] in unset_words):
@@ -564,97 +914,139 @@ def low_energy_fallback():
     # save the energy so that it can be used in the fallback check tomorrow
     ECS_energy_yesterday = ECS_energy_today + left_energy
         
+def apply_plan(power_delta):
+    """ Allocate power_delta (surplus if > 0, excess consumption if < 0) to the equipments by priority order.
+        The whole plan is computed first, then only the equipments whose power changes are commanded."""
+    start = time.perf_counter()
+    current = [e.get_current_power() for e in equipments]
+    forced = [e.is_forced() for e in equipments]
+    overed = [e.is_overed() for e in equipments]
+    targets = allocation.plan(power_delta, equipments_min_power, equipments_max_power, current, forced, overed,
+                              equipments_constant, KNAPSACK)
+    for e, old, new in zip(equipments, current, targets):
+        if e.controller is not None:
+            new = e.control(new)
+        if new != old:
+            debug(2, "{} : {}W -> {}W".format(e.name, int(old), int(new)))
+            e.set_current_power(new)
+    metrics.observe('plan', start)
+
+def publish_metrics():
+    """ Publish the metrics of the last period, and write the Prometheus file"""
+    mqtt_client.publish(TOPIC_METRICS, json.dumps(metrics.snapshot()))
+    if METRICS_FILE is not None:
+        try:
+            metrics.write_prometheus(METRICS_FILE)
+        except OSError as e:
+            log(2, "cannot write " + METRICS_FILE + " : " + str(e))
+
+def build_status(t, power_consumption, power_production, injection, grid):
+    """ Return the status message of an evaluation"""
+    msg = {
+        'date': int(t),
+        'date_str': datetime.datetime.fromtimestamp(t).strftime('%Y-%m-%d %H:%M:%S'),
+        'power_consumption': power_consumption,
+        'power_production': power_production,
+        'production_energy': round(production_energy),
+        'injection' : injection,
+        'grid' : grid,
+        'CLOUD_forecast' : CLOUD_forecast,
+        'ECS_energy_yesterday' : int(ECS_energy_yesterday),
+    }
+    power_equipments = 0
+    eq = []
+    for e in equipments:
+        p = int(e.get_current_power())       
+        power_equipments = power_equipments + p             
+        eq.append({
+            'name': e.name,
+            'current_power': 'unknown' if p is None else p,
+            'energy': e.get_energy(),
+            'overed' : e.is_overed(),
+            'forced': e.is_forced(),
+            'commands': e.commands_sent,
+            'suppressed': e.commands_suppressed
+        })
+    msg['power_equipments'] = power_equipments
+    msg['power_house'] = power_consumption - power_equipments
+    msg['equipments'] = eq
+    if scheduler is not None:
+        msg['scheduler'] = scheduler.stats()
+    msg['response'] = step_response.stats()
+    if predictor is not None:
+        msg['prediction'] = predictor.stats()
+    if pairer is not None:
+        msg['pairing'] = pairer.stats()
+    msg['domoticz'] = domoticz_out.stats()
+    if topic_filters:
+        msg['filters'] = {topic if key == 'power' else topic + ':' + key: chain.stats()
+                          for topic, chains in topic_filters.items() for key, chain in chains}
+    return msg
+
 def evaluate():
     # This is where all the magic happen. This function takes decision according to the current power measurements.
     # It examines the list of equipments by priority order, their current state and computes which one should be
     # turned on/off.
 
-    global last_evaluation_date, ECS_energy_today, last_injection, last_grid, CLOUD_forecast
+    global last_evaluation_date, ECS_energy_today, CLOUD_forecast, evaluations
     global equipments, equipment_water_heater, production_energy, fallback_today, init_today, cloud_requested, status
-    global power_production, power_consumption, last_production_date, last_consumption_date, status
-    global last_grid_date, last_injection_date,last_zero_grid_date, last_zero_injection_date
-    global SIM_FALLBACK, INIT_AT, INIT_AT_prev, CHECK_AT, CHECK_AT_prev, last_saveStatus_date, STATUS_TIME
-    TODAY = 0 
-    TOMORROW = 1
-
+    global SIM_FALLBACK, INIT_AT, INIT_AT_prev, CHECK_AT, CHECK_AT_prev, last_saveStatus_date, STATUS_TIME, fallback_job
+    global last_metrics_date
+    start = None
     try:
         t = now_ts()
+        # the equipment commands are held until the end of the evaluation, at most one per equipment is sent
+        equipment.begin_cycle()
         
         ##########
         # SCHEDULER
         if last_evaluation_date is not None: # Evaluating scheduler
             
-            # ensure there's a minimum duration between two evaluations
-            if t - last_evaluation_date < EVALUATION_PERIOD:
+            # ensure there's a minimum duration between two evaluations (the scheduler already runs at this period)
+            # (with the pairing, there is one evaluation per pair of readings)
+            if EVALUATE_ON_MESSAGE and pairer is None and t - last_evaluation_date < EVALUATION_PERIOD:
                 return
 
+            poll_fallback()
+
             d1 = datetime.datetime.fromtimestamp(last_evaluation_date)
             d2 = datetime.datetime.fromtimestamp(t)
 
-            if d1.minute == 20 and d2.minute == 21:  # every hours and 3 minutes (...14h03, 15h03...)
-                #print ("**************************************************************************")
-                send_keep_alive()  
-               
-            if d1.hour == INIT_AT_prev and d2.hour == INIT_AT and not init_today: # ensure it's not already done for today
-                log(0,"[evaluate] ECS energy / Over : " + str(equipment_water_heater.get_energy()) + " / " + str(equipment_water_heater.is_overed()))
-                equipment_water_heater.unset_over() # maybe it has been forced this night (low_energy_fallback)
-                equipment_water_heater.reset_energy()
-                log(0,"           ECS energy / Over : " + str(equipment_water_heater.get_energy()) + " / " + str(equipment_water_heater.is_overed()))
-                fallback_today = False
-                init_today = True
-                return
-
-            if SIM_FALLBACK and not fallback_today:
-                fallback_today = True
-                print("Simulating low_energy_fallback...")
-                low_energy_fallback()
-
-            if d1.hour == CHECK_AT_prev and d2.hour == CHECK_AT and not fallback_today:  # fallback_today : ensure it's not already done for today
-            #if True and not fallback_today:  # fallback_today : be sure it's not already done for today
-                fallback_today = True
-                log(0,"------------------------------------------------------------")
-                log(0,"[evaluate] Past Cloud / Production / Water_heater")
-                log(8, "csv : {} ; {} ; {}".format(CLOUD_forecast, int(production_energy), ECS_energy_today) )
-                CLOUD_forecast = -1
-                retry = 0
-                while CLOUD_forecast < 0 and retry < 5:
-                    log(0,"[evaluate] Cloud request : " + str(retry))
-                    retry = retry + 1
-                    if (CHECK_AT > 7 and CHECK_AT < 24):
-                        log(0,"[evaluate] Cloud Forecast Tomorrow : " + str(CLOUD_forecast))
-                        CLOUD_forecast = weather.getCloudAvg(TOMORROW)
-                    elif (CHECK_AT >= 0):
-                        log(0,"[evaluate] Cloud Forecast Today : " + str(CLOUD_forecast))
-                        CLOUD_forecast = weather.getCloudAvg(TODAY)
-                    time.sleep(5) # Delays for 5 seconds
-                log(0,"[evaluate] Cloud forcast : " + str(CLOUD_forecast))
-                if (CLOUD_forecast == -404):
-                    log(0,"*** cannot contact weather server")
-                    log(4,"FORCING CLOUD Forecast to 100 %")  
-                    CLOUD_forecast = 100 
-                elif (CLOUD_forecast == -1):
-                    log(0,"*** cloudForecast is out of range")
-                    log(4,"FORCING CLOUD Forecast to 100 %")   
-                    CLOUD_forecast = 100 
-
-                ECS_energy_today = equipment_water_heater.get_energy()
-                equipment_water_heater.reset_energy()
-                production_energy = 0
-                # ensure that water stays warm enough
-                low_energy_fallback()
-                init_today = False
-                return
+            if EVALUATE_CLOCK_JOBS: # the asyncio daemon runs these jobs on its own timers
+                if d1.minute == 20 and d2.minute == 21:  # every hours and 3 minutes (...14h03, 15h03...)
+                    #print ("**************************************************************************")
+                    send_keep_alive()  
+                   
+                if d1.hour == INIT_AT_prev and d2.hour == INIT_AT and not init_today: # ensure it's not already done for today
+                    daily_init()
+                    return
+
+                if SIM_FALLBACK and not fallback_today:
+                    fallback_today = True
+                    print("Simulating low_energy_fallback...")
+                    fallback_job = workers.submit(prepare_fallback, False)
+
+                if d1.hour == CHECK_AT_prev and d2.hour == CHECK_AT and not fallback_today:  # fallback_today : ensure it's not already done for today
+                #if True and not fallback_today:  # fallback_today : be sure it's not already done for today
+                    daily_check()
+                    # the forecast and Domoticz requests are slow: they run on the worker pool and low_energy_fallback()
+                    # is called by poll_fallback() when they are done, evaluations keep on going meanwhile
+                    fallback_job = workers.submit(prepare_fallback)
+                    return
 
         ##########
         last_evaluation_date = t
+        start = time.perf_counter()
+        # consistent snapshot of the measurements, they may be refreshed by the MQTT thread meanwhile
+        power_consumption, power_production, last_consumption_date, last_production_date = get_measurements()
         if power_production is None or power_consumption is None: # Return if None
             return
         if last_consumption_date is None or last_production_date is None:
             return  
 
         debug(0, '')
-        debug(0, '[evaluate] evaluating power CONS = {}, PROD = {}'.format(power_consumption, power_production))
-        debug(0, '[evaluate] ECS Energy today {}'.format(equipment_water_heater.get_energy()))
+        debug(0, '[evaluate] evaluating power CONS = %s, PROD = %s', power_consumption, power_production)
+        debug(0, '[evaluate] ECS Energy today %s', equipment_water_heater.get_energy())
 
         ##########
         # IS PZEM TIMEOUT ?
@@ -663,11 +1055,11 @@ def evaluate():
                 power_production = 0
                 delta_cons = int(t - last_consumption_date)
                 delta_prod = int(t - last_production_date )
-                log(0, "*** MQTT RX : PZEM CONSUMPTION ({}s) OR PRODUCTION ({}s) TIMEOUT".format(delta_cons, delta_prod))
+                log(0, "*** MQTT RX : PZEM CONSUMPTION (%ss) OR PRODUCTION (%ss) TIMEOUT", delta_cons, delta_prod)
                 log(4, "reset all power equipments to 0")
                 for e in equipments:
                     if e.is_forced():
-                        log(8, "skipping {} because it's forced".format(e.name))
+                        log(8, "skipping %s because it's forced", e.name)
                     else:
                         e.set_current_power(0)
         ##########
@@ -678,222 +1070,91 @@ def evaluate():
             # Check which equipment is over
             for e in reversed(equipments):
                 if e.measured_power is not None:
-                    e.check_over()
+                    e.check_over(pairer is not None)
+
+            step_response.update(power_production - MARGIN - power_consumption, t)
+            # the decisions are taken on the predicted consumption, the measured one is reported
+            measured_consumption = power_consumption
+            if predictor is not None:
+                power_consumption = predictor.predict(power_consumption, last_consumption_date)
 
             # if, TOO CONSUMPTION, POWER IS NEEDED, decrease the load
             if power_consumption > (power_production - MARGIN): 
                 excess_power = power_consumption - (power_production - MARGIN)
-                debug(0, "[evaluate] decreasing global power consumption by {}W".format(excess_power))
-                for e in reversed(equipments):
-                    debug(2, "1. examining " + e.name)
-                    if e.is_overed():
-                        debug(4, "skipping this equipment because it's already full loaded for today")
-                        continue
-                    if e.is_forced():
-                        debug(4, "skipping this equipment because it's in forced state")
-                        continue
-                    result = e.decrease_power_by(excess_power)
-                    if result is None:
-                        debug(2, "stopping here and waiting for the next measurement to see the effect")
-                        break
-                    excess_power -= result
-                    if excess_power <= 0:
-                        debug(2, "[no more excess power consumption, stopping here")
-                        break
-                    else:
-                        debug(2, "There is {}W left to cancel, continuing".format(excess_power))
-                debug(2, "No more equipment to check")
+                debug(0, "[evaluate] decreasing global power consumption by %sW", excess_power)
+                apply_plan(-excess_power)
             elif (power_production - MARGIN - power_consumption) < BALANCE_THRESHOLD: 
                 # Nice, this is the goal: CONSUMPTION is EQUAL to PRODUCTION
                 debug(0, "[evaluate] power consumption and production are balanced")
+                if controllers:
+                    apply_plan(0) # the PI controllers are fed with a null error
             else: # There's PV POWER IN EXCESS, try to increase the load to consume this available power
                 available_power = power_production - MARGIN - power_consumption
-                debug(0, "[evaluate] increasing global power consumption by {}W".format(available_power))
-                for i, e in enumerate(equipments):                
-                    if available_power <= 0:
-                        debug(2, "no more available power")
-                        break
-                    debug(2, "2. examining " + e.name)
-
-                    if e.is_overed():
-                        debug(4, "skipping this equipment because it's already full loaded for today")
-                        
-                        continue
-                    if e.is_forced():
-                        debug(4, "skipping this equipment because it's in forced state")
-                        
-                        continue
-                    result = e.increase_power_by(available_power)
-                    if result is None:
-                        debug(2, "stopping here and waiting for the next measurement to see the effect")
-                        break
-                    elif result == 0:
-                        debug(2, "no more available power to use, stopping here")
-                        break
-                    elif result < 0:
-                        debug(2, "not enough available power to turn on this equipment, trying to recover power on lower priority equipments")
-         
-                        freeable_power = 0
-                        needed_power = -result
-                        for j in range(i + 1, len(equipments)):
-                            o = equipments[j]
-                            if o.is_forced():
-                                continue
-                            p = o.get_current_power()
-                            if p is not None:
-                                freeable_power += p
-                        debug(2, "power used by other equipments: {}W, needed: {}W".format(freeable_power, needed_power))
-                        if freeable_power >= needed_power:
-                            debug(2, "recovering power")
-                            freed_power = 0
-                            for j in reversed(range(i + 1, len(equipments))):
-                                o = equipments[j]
-                                if o.is_forced():
-                                    continue
-                                result = o.decrease_power_by(needed_power)
-                                freed_power += result
-                                needed_power -= result
-                                if needed_power <= 0:
-                                    debug(2, "enough power has been recovered, stopping here")
-                                    break
-                            new_available_power = available_power + freed_power
-                            debug(2, "now trying again to increase power of {} with {}W".format(e.name, new_available_power))
-                            available_power = e.increase_power_by(new_available_power)
-                        else:
-                            debug(2, "this is not possible to recover enough power on lower priority equipments")
-                    else:
-                        available_power = result
-                        debug(2, "there is {}W left to use, continuing".format(available_power))
-                debug(2, "no more equipment to check")
+                debug(0, "[evaluate] increasing global power consumption by %sW", available_power)
+                apply_plan(available_power)
+            power_consumption = measured_consumption
+        if predictor is not None:
+            predictor.commanded(sum(e.get_current_power() for e in equipments), t)
         
         ##########
         # DOMOTICZ COMMUNICATION
-        if SEND_DOMOTICZ: # THEN SEND GRID & INJECTION MESSAGE
-            injection = (power_consumption - power_production) 
-            if injection < 0:   # This is INJECTION
-                grid = 0
-                last_injection_date = t
-            else:               # This is GRID
-                grid = injection
-                injection = 0
-                last_grid_date = t
-            #print ("***** SIMULATION DOMOTICZ INJECTION GRID : {} {} {} {}".format(SIMULATION, SEND_DOMOTICZ, SEND_INJECTION, SEND_GRID)) if SDEBUG else ''
-            ### HERE Prepare and send  INJECTION MESSAGE
+        injection = (power_consumption - power_production) 
+        if injection < 0:   # This is INJECTION
+            grid = 0
+        else:               # This is GRID
+            grid = injection
+            injection = 0
+        if SEND_DOMOTICZ: # THEN SEND GRID & INJECTION MESSAGE
             if SEND_INJECTION:
-                if injection < 0 and last_injection == 0 and (t - last_injection_date) > 20 : 
-                    # This Workaround is needed in order to improve Grafana Integral calculation. Send 0.
-                    domoticz = "{ \"idx\": " + IDX_INJECTION + ", \"nvalue\": 0, \"svalue\": \"0\"}"
-                    mqtt_client.publish(TOPIC_DOMOTICZ_IN, domoticz) 
-                    print(TOPIC_DOMOTICZ_IN, domoticz) if SDEBUG else ''
-                if injection < 0:
-                    domoticz = "{ \"idx\": " + IDX_INJECTION + ", \"nvalue\": 0, \"svalue\": \"" + str(injection) + "\"}"
-                    mqtt_client.publish(TOPIC_DOMOTICZ_IN, domoticz) 
-                    print(TOPIC_DOMOTICZ_IN, domoticz) if SDEBUG else ''
-            
-                if injection == 0 and last_injection == 0:
-                    # Do not repeat this point 
-                    pass
-                elif injection == 0:
-                    domoticz = "{ \"idx\": " + IDX_INJECTION + ", \"nvalue\": 0, \"svalue\": \"0\"}"
-                    mqtt_client.publish(TOPIC_DOMOTICZ_IN, domoticz) 
-                    print(TOPIC_DOMOTICZ_IN, domoticz) if SDEBUG else ''
-                    
-            ### HERE Prepare and send  GRID MESSAGE
+                domoticz_out.update(mqtt_client, 'injection', injection, t)
             if SEND_GRID:
-                if grid > 0 and last_grid == 0 and (t - last_grid_date) > 20 : 
-                    # This Workaround is needed to improve Grafana Integral calculation. Send 0.
-                    domoticz = "{ \"idx\": " + IDX_GRID + ", \"nvalue\": 0, \"svalue\": \"0\"}"
-                    mqtt_client.publish(TOPIC_DOMOTICZ_IN, domoticz)
-                    print(TOPIC_DOMOTICZ_IN, domoticz) if SDEBUG else ''
-                if grid > 0:
-                    domoticz = "{ \"idx\": " + IDX_GRID + ", \"nvalue\": 0, \"svalue\": \"" + str(grid) + "\"}"
-                    mqtt_client.publish(TOPIC_DOMOTICZ_IN, domoticz)
-                    print(TOPIC_DOMOTICZ_IN, domoticz) if SDEBUG else ''
-
-                if grid == 0 and last_grid == 0:
-                    # Do not repeat this point if last zero grid is not older than 30min (this is a keepalive for Domoticz)
-                    if (t - last_zero_grid_date > 1800 ):
-                        domoticz = "{ \"idx\": " + IDX_GRID + ", \"nvalue\": 0, \"svalue\": \"0\"}"
-                        mqtt_client.publish(TOPIC_DOMOTICZ_IN, domoticz)
-                        print(TOPIC_DOMOTICZ_IN, domoticz) if SDEBUG else ''
-                        last_zero_grid_date = t
-                elif grid == 0:
-                    domoticz = "{ \"idx\": " + IDX_GRID + ", \"nvalue\": 0, \"svalue\": \"0\"}"
-                    mqtt_client.publish(TOPIC_DOMOTICZ_IN, domoticz)
-                    print(TOPIC_DOMOTICZ_IN, domoticz) if SDEBUG else ''
-                    last_zero_grid_date = t
+                domoticz_out.update(mqtt_client, 'grid', grid, t)
             print("[evaluate]                    CALCULATED INJECTION :", injection) if SDEBUG else ''
             print("[evaluate]                    CALCULATED GRID      :", grid) if SDEBUG else ''        
-            last_injection = injection
-            last_grid = grid
   
         ##########
         # Build an MQTT status message, and status file
-        status = None
-        msg = {
-            'date': int(t),
-            'date_str': datetime.datetime.fromtimestamp(t).strftime('%Y-%m-%d %H:%M:%S'),
-            'power_consumption': power_consumption,
-            'power_production': power_production,
-            'production_energy': round(production_energy),
-            'injection' : injection,
-            'grid' : grid,
-            'CLOUD_forecast' : CLOUD_forecast,
-            'ECS_energy_yesterday' : int(ECS_energy_yesterday),
-        }
-        power_equipments = 0
-        eq = []
-        for e in equipments:
-            p = int(e.get_current_power())       
-            power_equipments = power_equipments + p             
-            eq.append({
-                'name': e.name,
-                'current_power': 'unknown' if p is None else p,
-                'energy': e.get_energy(),
-                'overed' : e.is_overed(),
-                'forced': e.is_forced()
-            })
-        msg['power_equipments'] = power_equipments
-        msg['power_house'] = power_consumption - power_equipments
-        msg['equipments'] = eq
-        status = msg
-        mqtt_client.publish(TOPIC_STATUS, json.dumps(msg))
-        if last_saveStatus_date is None:
-            last_saveStatus_date = t
-        else:
-            if t - last_saveStatus_date > STATUS_TIME and STATUS_TIME >= 60:
+        evaluations += 1
+        if history is not None:
+            history.sample(t, power_production, power_consumption, [e.get_current_power() for e in equipments])
+        if status_publisher.due(t):
+            stage = time.perf_counter()
+            status = build_status(t, power_consumption, power_production, injection, grid)
+            metrics.observe('status', stage)
+            status_publisher.publish(mqtt_client, status, t)
+        if EVALUATE_CLOCK_JOBS:
+            if last_saveStatus_date is None:
+                last_saveStatus_date = t
+            elif t - last_saveStatus_date > STATUS_TIME and STATUS_TIME >= 60:
                 saveStatus()    
                 last_saveStatus_date = t
+            if METRICS_PERIOD > 0:
+                if last_metrics_date is None:
+                    last_metrics_date = t
+                elif t - last_metrics_date >= METRICS_PERIOD:
+                    publish_metrics()
+                    last_metrics_date = t
 
     except Exception as e:
         log(0,"[evaluate exception]") 
         log(1, "*** Error on line {}".format(sys.exc_info()[-1].tb_lineno))
         log(1, e)
+    finally:
+        equipment.end_cycle()
+        if start is not None:
+            metrics.observe('evaluate', start)
 
 ###############################################################
 # MAIN
 
-def main():
-    global mqtt_client, equipments, equipment_water_heater
-    signal.signal(signal.SIGINT, signal_handler) 
-    signal.signal(signal.SIGHUP, signal_handler) 
-    signal.signal(signal.SIGUSR1, signal_handler)
-    signal.signal(signal.SIGBUS, signal_handler)
-    
-    if os.uname()[1] == "raspberry":
-        while checkProcessRunning("mosquitto") is False:
-            time.sleep(5)
-
-    debug(0,"")
-    log(0,"")
-    log(0,"[Main] Starting PV Power Regulation @" + config['cloudForecast']['location'])
-
-    mqtt_client = mqtt.Client()
-    equipment.setup(mqtt_client, SIMULATION, prefix)
-   
+def init_equipments():
+    """ Build the equipments list from config.ini, every equipment is reset to 0W"""
+    global equipments, equipment_water_heater, equipments_by_name
+    global equipments_min_power, equipments_max_power, equipments_constant, controllers
     # Dynamic Load of equipments list
     # This list of EQUIPMENTS IS PRIORITY ORDERED (first one has the higher priority). 
     # As many equipments as needed can be listed in config.ini, [equiments] section.
+    equipments = ()
     log(0, "Making list of equipments :")
     i = -1
     for eq_name in config['equipments']:
@@ -913,7 +1174,7 @@ def main():
             continue
         if ( type == "variable"):
             log(1, "Instancing [" + eq_name + "] as 'variable' equipment") 
-            equipments += (ConstantPowerEquipment(eq_name),) # append it to the end of list
+            equipments += (VariablePowerEquipment(eq_name),) # append it to the end of list
             continue
         
     #equipment_water_heater = VariablePowerEquipment('ECS')
@@ -929,8 +1190,45 @@ def main():
         log(1, str(eq.name) + " power max : " + str(eq.MAX_POWER) + " W" )
         if (eq.type == "variable"):
             log(1, str(eq.name) + " percent min : " + str(eq.MIN_PERCENT) + " %" )
+    equipments_by_name = {e.name: e for e in equipments}
+    equipments_min_power = tuple(e.MIN_POWER for e in equipments)
+    equipments_max_power = tuple(e.MAX_POWER for e in equipments)
+    equipments_constant = tuple(e.type == "constant" for e in equipments)
+    controllers = any(e.controller is not None for e in equipments)
+    init_topic_handlers()
+
+def set_evaluation_period(period):
+    """ Change EVALUATION_PERIOD and what was built from it (pairer, PI controllers), after init_equipments()"""
+    global EVALUATION_PERIOD, pairer
+    EVALUATION_PERIOD = period
+    if pairer is not None:
+        pairer = pairing.SamplePairer(PAIR_WINDOW, PZEM_TIMEOUT, 2 * period)
+    for e in equipments:
+        if e.controller is not None:
+            e.controller.period = period
+
+def main():
+    global mqtt_client, scheduler
+    signal.signal(signal.SIGINT, signal_handler) 
+    signal.signal(signal.SIGHUP, signal_handler) 
+    signal.signal(signal.SIGUSR1, signal_handler)
+    signal.signal(signal.SIGBUS, signal_handler)
+    
+    wait_broker()
 
-    loadStatus() if (config['debug']['use_persistent'] in set_words) else ''
+    debug(0,"")
+    log(0,"")
+    log(0,"[Main] Starting PV Power Regulation @" + config['cloudForecast']['location'])
+
+    # paho is imported here, the regulation module can be loaded (tools, replay) without it
+    import paho.mqtt.client as mqtt
+    mqtt_client = init_trace(mqtt.Client())
+    equipment.setup(mqtt_client, SIMULATION, prefix)
+    init_equipments()
+    init_history()
+    if config['debug']['use_persistent'] in set_words:
+        loadStatus()
+        compactStatus()
         
     mqtt_client.on_connect = on_connect
     mqtt_client.on_message = on_message
@@ -939,6 +1237,9 @@ def main():
     except:
         print("Cannot connect " + MQTT_BROKER)
         sys.exit()
+    if SCHEDULER:
+        scheduler = FixedRateScheduler(EVALUATION_PERIOD, control_tick, "regulation")
+        scheduler.start()
     mqtt_client.loop_forever()
 
 if __name__ == '__main__':
@@ -0,0 +1,271 @@
+#!/usr/bin/python3
+#!/usr/bin/env python
+
+# Copyright (C) 2020-2022 Coturex - F5RQG
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# asyncio entry point of the power regulation, an alternative to regulation.main() and mqtt_client.loop_forever().
+# Everything runs in a single event loop:
+# - the MQTT socket is driven by the loop (paho external loop API: add_reader/add_writer and loop_misc every second)
+# - keep-alive, INIT_AT, CHECK_AT and status saving are cancellable timer tasks instead of being checked by evaluate()
+# - the Domoticz 'getdeviceinfo' exchange is awaited (request/response), no more time.sleep()
+# The regulation itself (evaluate, fallback, status...) is the one of the regulation module.
+#
+# $> ./regulation_async.py
+
+import asyncio, signal, datetime, sys
+import paho.mqtt.client as mqtt
+
+from debug_log import log as log
+from debug_log import debug as debug
+
+import regulation
+import equipment
+
+RECONNECT_DELAY = 5
+
+loop = None
+tasks = []
+ecs_mode_waiters = []
+stopping = False
+
+
+class MqttLoop:
+    """ Drive the socket of a paho client from the asyncio event loop"""
+    def __init__(self, loop, client):
+        self.loop = loop
+        self.client = client
+        self.misc = None
+        client.on_socket_open = self.on_socket_open
+        client.on_socket_close = self.on_socket_close
+        client.on_socket_register_write = self.on_socket_register_write
+        client.on_socket_unregister_write = self.on_socket_unregister_write
+
+    def on_socket_open(self, client, userdata, sock):
+        self.loop.add_reader(sock, client.loop_read)
+        self.misc = self.loop.create_task(self.misc_loop())
+
+    def on_socket_close(self, client, userdata, sock):
+        self.loop.remove_reader(sock)
+        if self.misc is not None:
+            self.misc.cancel()
+            self.misc = None
+
+    def on_socket_register_write(self, client, userdata, sock):
+        self.loop.add_writer(sock, client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self.loop.remove_writer(sock)
+
+    async def misc_loop(self):
+        # MQTT keep-alive pings and retries, paho expects loop_misc() to be called about every second
+        while self.client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+            await asyncio.sleep(1)
+
+
+###############################################################
+# MQTT CALLBACKS
+
+def on_message(client, userdata, msg):
+    regulation.on_message(client, userdata, msg)
+    if msg.topic == regulation.TOPIC_ECSMODE:
+        # answer to a getdeviceinfo request
+        for future in ecs_mode_waiters:
+            if not future.done():
+                future.set_result(regulation.ECS_MODE)
+        ecs_mode_waiters.clear()
+
+def on_disconnect(client, userdata, rc):
+    if not stopping:
+        log(0, "[regulation_async] disconnected from broker (rc {}), reconnecting".format(rc))
+        loop.create_task(connect(client, reconnect=True))
+
+async def connect(client, reconnect=False):
+    # The broker may not be ready yet (mosquitto starting on the same host), retry until it answers. At start, for at
+    # most broker_wait seconds (a wrong broker_ip ends the program), a lost connection is retried forever
+    deadline = loop.time() + regulation.BROKER_WAIT
+    while not stopping:
+        try:
+            if reconnect:
+                client.reconnect()
+            else:
+                client.connect(regulation.MQTT_BROKER, regulation.PORT, 120)
+            return
+        except OSError as e:
+            log(0, "[regulation_async] cannot connect " + regulation.MQTT_BROKER + " : " + str(e))
+            if not reconnect and loop.time() + RECONNECT_DELAY > deadline:
+                print("Cannot connect " + regulation.MQTT_BROKER)
+                sys.exit(1)
+            await asyncio.sleep(RECONNECT_DELAY)
+
+async def request_ECS_mode(timeout=None):
+    """ Request the ECS mode to Domoticz and wait for the answer, return the last known mode on timeout"""
+    future = loop.create_future()
+    ecs_mode_waiters.append(future)
+    regulation.request_ECS_mode()
+    try:
+        return await asyncio.wait_for(future, timeout or regulation.ECS_MODE_TIMEOUT)
+    except asyncio.TimeoutError:
+        log(2, "no ECS_MODE answer from Domoticz, keeping " + str(regulation.ECS_MODE))
+        return regulation.ECS_MODE
+    finally:
+        if future in ecs_mode_waiters:
+            ecs_mode_waiters.remove(future)
+
+
+###############################################################
+# TIMERS
+
+def next_date(minute, hour=None):
+    """ Return the timestamp of the next hh:mm, or of the next xx:mm every hour when hour is None"""
+    now = datetime.datetime.fromtimestamp(regulation.now_ts())
+    date = now.replace(minute=minute, second=0, microsecond=0)
+    if hour is not None:
+        date = date.replace(hour=hour)
+    step = datetime.timedelta(hours=1 if hour is None else 24)
+    while date <= now:
+        date += step
+    return date.timestamp()
+
+async def sleep_until(ts):
+    # wake up at least every minute, the wall clock may be adjusted meanwhile (NTP sync on a Pi without RTC)
+    while True:
+        delay = ts - regulation.now_ts()
+        if delay <= 0:
+            return
+        await asyncio.sleep(min(delay, 60))
+
+async def run_job(name, job):
+    try:
+        result = job()
+        if asyncio.iscoroutine(result):
+            await result
+    except Exception as e:
+        log(0, "[regulation_async] {} failed".format(name))
+        log(1, "*** Error on line {}".format(sys.exc_info()[-1].tb_lineno))
+        log(1, e)
+
+async def at(name, job, minute, hour=None):
+    """ Timer: run the job every day at hour:minute, or every hour at minute when hour is None"""
+    while True:
+        await sleep_until(next_date(minute, hour))
+        debug(0, "[regulation_async] timer " + name)
+        await run_job(name, job)
+
+async def every(name, job, period):
+    """ Timer: run the job at a fixed rate, missed periods are skipped"""
+    deadline = loop.time() + period
+    while True:
+        await asyncio.sleep(max(0, deadline - loop.time()))
+        await run_job(name, job)
+        deadline += period
+        if loop.time() > deadline:
+            deadline = loop.time() + period
+
+
+###############################################################
+# JOBS
+
+async def daily_check():
+    regulation.daily_check()
+    # weather request is blocking (requests), it runs on the regulation worker pool
+    regulation.CLOUD_forecast = await loop.run_in_executor(regulation.workers, regulation.fetch_cloud_forecast)
+    await request_ECS_mode()
+    # ensure that water stays warm enough
+    regulation.low_energy_fallback()
+
+async def simulate_fallback():
+    print("Simulating low_energy_fallback...")
+    regulation.fallback_today = True
+    await request_ECS_mode()
+    regulation.low_energy_fallback()
+
+async def shutdown(sig, stop):
+    """ End of program, set equipments 0W and save status"""
+    global stopping
+    if stopping:
+        return
+    stopping = True
+    print ("!! Received end signal : " + sig.name)
+    log(0, "[regulation_async] !! Received end signal : " + sig.name)
+    for task in tasks:
+        task.cancel()
+    for e in regulation.equipments:
+        e.set_current_power(0)
+        log(2, e.name + " : set power to 0")
+    await asyncio.sleep(1) # let the event loop send the commands
+    log(4, "[saveStatus] saving status")
+    regulation.saveStatus(True) if (regulation.config['debug']['use_persistent'] in regulation.set_words) else ''
+    regulation.mqtt_client.disconnect()
+    regulation.workers.shutdown(wait=False, cancel_futures=True)
+    if regulation.recorder is not None:
+        regulation.recorder.close()
+    if regulation.history is not None:
+        regulation.history.flush()
+    log(0, "Bye")
+    stop.set()
+
+
+###############################################################
+# MAIN
+
+async def run():
+    global loop
+    loop = asyncio.get_running_loop()
+    # timers below replace the clock checks of evaluate(), which is called by messages or by the 'every' timer
+    regulation.EVALUATE_CLOCK_JOBS = False
+    regulation.EVALUATE_ON_MESSAGE = not regulation.SCHEDULER
+
+    debug(0,"")
+    log(0,"")
+    log(0,"[Main] Starting PV Power Regulation (asyncio) @" + regulation.config['cloudForecast']['location'])
+
+    client = regulation.init_trace(mqtt.Client())
+    regulation.mqtt_client = client
+    equipment.setup(client, regulation.SIMULATION, regulation.prefix)
+    regulation.init_equipments()
+    regulation.init_history()
+    if regulation.config['debug']['use_persistent'] in regulation.set_words:
+        regulation.loadStatus()
+        regulation.compactStatus()
+
+    client.on_connect = regulation.on_connect
+    client.on_message = on_message
+    client.on_disconnect = on_disconnect
+    MqttLoop(loop, client)
+
+    stop = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM, signal.SIGHUP, signal.SIGUSR1):
+        loop.add_signal_handler(sig, lambda s=sig: loop.create_task(shutdown(s, stop)))
+
+    await connect(client)
+
+    tasks.append(loop.create_task(at("keep_alive", regulation.send_keep_alive, 21)))
+    tasks.append(loop.create_task(at("init", regulation.daily_init, 0, regulation.INIT_AT)))
+    tasks.append(loop.create_task(at("check", daily_check, 0, regulation.CHECK_AT)))
+    if regulation.STATUS_TIME >= 60:
+        tasks.append(loop.create_task(every("save_status", regulation.saveStatus, regulation.STATUS_TIME)))
+    if regulation.SCHEDULER:
+        tasks.append(loop.create_task(every("evaluate", regulation.evaluate, regulation.EVALUATION_PERIOD)))
+    if regulation.METRICS_PERIOD > 0:
+        tasks.append(loop.create_task(every("metrics", regulation.publish_metrics, regulation.METRICS_PERIOD)))
+    if regulation.SIM_FALLBACK:
+        tasks.append(loop.create_task(simulate_fallback()))
+
+    await stop.wait()
+
+def main():
+    asyncio.run(run())
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,276 @@
+#!/usr/bin/python3
+
+# Copyright (C) 2020-2022 Coturex - F5RQG
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Replay engine: a recorded stream of MQTT messages (consumption, production, read power...) goes through
+# regulation.on_message() and evaluate() with a virtual clock, much faster than real time. Nothing is sent: the
+# publications are captured, the cloud forecast is a fixed value and the worker jobs run inline. The regulation is the
+# one of config.ini (current directory), status.ini is neither read nor written.
+#
+# Closed loop (default): the regulation of the recording is replaced by the replayed one. The house load is the
+# recorded consumption minus the last recorded read power of the equipments, the replayed consumption adds the power
+# commanded to them, and their read power messages carry that power. The equipments without topic_read_power are
+# assumed off in the recording, and there is no thermostat in this model (an equipment absorbs what it is commanded).
+# With --lag, the equipments absorb the power commanded 'lag' seconds before (load response and PZEM integration).
+# Open loop (--open-loop): the messages are replayed as recorded.
+#
+# Recording: a trace of the regulation (mqtt_trace.py, rotated files included), or one JSON object per line
+# {"ts": 1666000000.0, "topic": "...", "payload": "..."}. The messages sent by the recorded regulation are skipped.
+#
+# $> python3 replay.py trace.bin|day.jsonl [--cloud 50] [--open-loop] [--lag 0] [--json]
+
+import argparse, collections, datetime, importlib, json, logging, sys, time
+from concurrent.futures import Future
+
+import clock
+import equipment
+import regulation
+import mqtt_trace
+
+
+class CaptureClient:
+    """ MQTT client of the replay: the publications are recorded instead of being sent"""
+    def __init__(self):
+        self.messages = []
+        self.counts = {}
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.messages.append((clock.now_ts(), topic, payload))
+        self.counts[topic] = self.counts.get(topic, 0) + 1
+
+    def subscribe(self, topic, qos=0):
+        pass
+
+
+class InlineExecutor:
+    """ Worker pool of the replay: the jobs run when they are submitted, in virtual time"""
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def shutdown(self, wait=True, cancel_futures=False):
+        pass
+
+
+class FixedForecast:
+    def __init__(self, cloud):
+        self.cloud = cloud
+
+    def getCloudAvg(self, sDAY):
+        return self.cloud
+
+
+class Message:
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+
+
+def read_jsonl(path):
+    """ Iterate over the (ts, topic, payload) of a JSON lines recording"""
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            j = json.loads(line)
+            if j.get('sent'):
+                continue
+            payload = j['payload']
+            if not isinstance(payload, str):
+                payload = json.dumps(payload)
+            yield float(j['ts']), j['topic'], payload.encode()
+
+def read_recording(path):
+    """ Iterate over the (ts, topic, payload) received in a trace or in a JSON lines recording"""
+    if not mqtt_trace.is_trace(path):
+        yield from read_jsonl(path)
+        return
+    for ts, kind, topic, payload in mqtt_trace.read_all(path):
+        if kind == mqtt_trace.RECEIVED:
+            yield ts, topic, payload
+
+def reset():
+    """ Reload the regulation modules: fresh equipments, counters and module state for a new replay"""
+    importlib.reload(equipment)
+    importlib.reload(regulation)
+
+def run(events, cloud=50, closed_loop=True, setup=None, lag=0):
+    """ Replay the events (ts, topic, payload) and return the report
+    setup(regulation) is called once the equipments are built, to change the settings of this replay
+    lag : delay (s) between a command and the power absorbed by the equipment, closed loop only"""
+    virtual = clock.VirtualClock()
+    previous = clock.set_clock(virtual)
+    try:
+        reset()
+        return _run(iter(events), virtual, cloud, closed_loop, setup, lag)
+    finally:
+        clock.set_clock(previous)
+
+def _run(events, virtual, cloud, closed_loop, setup, lag):
+    start = time.perf_counter()
+    first = next(events, None)
+    if first is None:
+        return None
+    virtual.set(first[0])
+
+    client = CaptureClient()
+    regulation.mqtt_client = client
+    equipment.setup(client, regulation.SIMULATION, regulation.prefix)
+    regulation.workers = InlineExecutor()
+    regulation.weather = FixedForecast(cloud)
+    regulation.ECS_MODE_TIMEOUT = 0
+    regulation.STATUS_TIME = 0
+    regulation.init_equipments()
+    if setup is not None:
+        setup(regulation)
+    period = None
+    if regulation.SCHEDULER:
+        # the scheduler thread is replaced by evaluations at the scheduler period, in virtual time
+        regulation.EVALUATE_ON_MESSAGE = False
+        period = regulation.EVALUATION_PERIOD
+
+    # closed loop: read power topics -> {json key: equipments}, last recorded read power by (topic, key)
+    readers = {}
+    for e in regulation.equipments:
+        if e.topic_read_power is not None:
+            readers.setdefault(e.topic_read_power, {}).setdefault(e.json_read_power, []).append(e)
+    looped = [e for keys in readers.values() for eqs in keys.values() for e in eqs]
+    recorded = {}
+    house = None
+    # commanded powers of the looped equipments by date, to read them 'lag' seconds later
+    commanded = collections.deque([(first[0], tuple(0 for e in looped))])
+
+    def absorbed():
+        """ {equipment: power absorbed now}"""
+        if lag <= 0:
+            return {e: e.get_current_power() for e in looped}
+        now = virtual.time()
+        powers = tuple(e.get_current_power() for e in looped)
+        if powers != commanded[-1][1]:
+            commanded.append((now, powers))
+        while len(commanded) > 1 and commanded[1][0] <= now - lag:
+            commanded.popleft()
+        return dict(zip(looped, commanded[0][1]))
+
+    energy = dict.fromkeys(('production', 'consumption', 'grid', 'injection'), 0.0)
+    equipment_energy = dict.fromkeys((e.name for e in regulation.equipments), 0.0)
+    messages = 0
+
+    def consumption():
+        if closed_loop and house is not None:
+            return house + sum(absorbed().values())
+        return regulation.power_consumption
+
+    def advance(ts):
+        # integrate the powers held since the previous date
+        dt = ts - virtual.time()
+        if dt <= 0:
+            return
+        cons, prod = consumption(), regulation.power_production
+        if cons is not None and prod is not None:
+            energy['production'] += prod * dt
+            energy['consumption'] += cons * dt
+            if cons > prod:
+                energy['grid'] += (cons - prod) * dt
+            else:
+                energy['injection'] += (prod - cons) * dt
+        for e in regulation.equipments:
+            equipment_energy[e.name] += e.get_current_power() * dt
+        virtual.set(ts)
+
+    next_tick = first[0] + period if period else None
+    event = first
+    while event is not None:
+        ts, topic, payload = event
+        while next_tick is not None and next_tick <= ts:
+            advance(next_tick)
+            regulation.evaluate()
+            next_tick += period
+        advance(ts)
+        if closed_loop:
+            if topic in readers:
+                j = json.loads(payload.decode())
+                powers = absorbed()
+                for key, eqs in readers[topic].items():
+                    if key in j:
+                        recorded[(topic, key)] = float(j[key])
+                        j[key] = sum(powers[e] for e in eqs)
+                payload = json.dumps(j).encode()
+            elif topic == regulation.TOPIC_SENSOR_CONSUMPTION:
+                j = json.loads(payload.decode())
+                house = max(0, float(j['power']) - sum(recorded.values()))
+                j['power'] = int(consumption())
+                payload = json.dumps(j).encode()
+        regulation.on_message(client, None, Message(topic, payload))
+        messages += 1
+        event = next(events, None)
+
+    return {
+        'start': first[0],
+        'end': virtual.time(),
+        'messages': messages,
+        'evaluations': regulation.evaluations,
+        'elapsed': time.perf_counter() - start,
+        'energy': {k: v / 3600.0 for k, v in energy.items()},
+        'equipments': {e.name: {
+            'type': e.type,
+            'energy': equipment_energy[e.name] / 3600.0,
+            'commands': e.commands_sent,
+            'suppressed': e.commands_suppressed,
+        } for e in regulation.equipments},
+        'publications': client.counts,
+    }
+
+def print_report(report):
+    duration = report['end'] - report['start']
+    print("replayed {} -> {} ({:.0f}s), {} messages in {:.2f}s ({:.0f}x real time)".format(
+        datetime.datetime.fromtimestamp(report['start']).strftime('%Y-%m-%d %H:%M:%S'),
+        datetime.datetime.fromtimestamp(report['end']).strftime('%Y-%m-%d %H:%M:%S'),
+        duration, report['messages'], report['elapsed'], duration / report['elapsed'] if report['elapsed'] else 0))
+    print("{:20} {}".format('evaluations', report['evaluations']))
+    for k in ('production', 'consumption', 'grid', 'injection'):
+        print("{:20} {:10.0f} Wh".format(k, report['energy'][k]))
+    for name, e in report['equipments'].items():
+        print("{:20} {:10.0f} Wh, {} commands, {} suppressed".format(name, e['energy'], e['commands'], e['suppressed']))
+    for topic, n in sorted(report['publications'].items()):
+        print("{:20} {:10} publications on {}".format('', n, topic))
+
+def main():
+    parser = argparse.ArgumentParser(description="replay a recorded day through the regulation")
+    parser.add_argument('recording', help="trace file or JSON lines recording")
+    parser.add_argument('--cloud', type=int, default=50, help="cloud forecast (percent) given to the fallback")
+    parser.add_argument('--open-loop', action='store_true', help="replay the messages as recorded")
+    parser.add_argument('--lag', type=float, default=0, help="seconds between a command and the absorbed power")
+    parser.add_argument('--json', action='store_true', help="print the report as JSON")
+    parser.add_argument('--log', action='store_true', help="keep the regulation logs (log/debug files of config.ini)")
+    args = parser.parse_args()
+
+    if not args.log:
+        logging.getLogger('regulation_log').disabled = True
+        logging.getLogger('regulation_debug').disabled = True
+    report = run(read_recording(args.recording), args.cloud, not args.open_loop, lag=args.lag)
+    if report is None:
+        print("empty recording")
+        sys.exit(1)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+# Copyright (C) 2020-2022 Coturex - F5RQG
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Fixed rate scheduler, used by the regulation loop when evaluate() must not run in the MQTT network thread.
+# The task is started at a fixed cadence (deadlines are computed from the start date, they do not drift with the
+# task duration). The delay between a deadline and the real start of the task (jitter) is measured, and a tick is
+# counted as an overrun when the task is still running at the next deadline: the missed ticks are then skipped.
+
+import threading, time, sys
+from debug_log import log as log
+
+
+class FixedRateScheduler:
+    def __init__(self, period, task, name="scheduler"):
+        self.period = period
+        self.task = task
+        self.name = name
+        self.ticks = 0
+        self.overruns = 0
+        self.skipped = 0
+        self.jitter_last = 0
+        self.jitter_max = 0
+        self.jitter_sum = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """ Start the control thread, the first tick happens one period later"""
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self._thread.start()
+        log(0, "[{}] started, period {}s".format(self.name, self.period))
+
+    def stop(self, timeout=None):
+        """ Stop the control thread, wait for the running tick to complete"""
+        self._stop.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout)
+        self._thread = None
+
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def _run(self):
+        deadline = time.monotonic() + self.period
+        while not self._stop.wait(max(0, deadline - time.monotonic())):
+            start = time.monotonic()
+            jitter = start - deadline
+            self.ticks += 1
+            self.jitter_last = jitter
+            self.jitter_sum += jitter
+            if jitter > self.jitter_max:
+                self.jitter_max = jitter
+            try:
+                self.task()
+            except Exception as e:
+                log(0, "[{}] task exception".format(self.name))
+                log(1, "*** Error on line {}".format(sys.exc_info()[-1].tb_lineno))
+                log(1, e)
+            deadline += self.period
+            end = time.monotonic()
+            if end > deadline:
+                # the task has been longer than the period, skip the missed ticks and keep the original phase
+                missed = int((end - deadline) // self.period) + 1
+                self.overruns += 1
+                self.skipped += missed
+                deadline += missed * self.period
+
+    def stats(self):
+        """ Return scheduler counters, jitter values are in milliseconds"""
+        return {
+            'period': self.period,
+            'ticks': self.ticks,
+            'overruns': self.overruns,
+            'skipped': self.skipped,
+            'jitter_last': round(self.jitter_last * 1000, 2),
+            'jitter_max': round(self.jitter_max * 1000, 2),
+            'jitter_avg': round(self.jitter_sum * 1000 / self.ticks, 2) if self.ticks else 0,
+        }
@@ -0,0 +1,96 @@
+# Copyright (C) 2020-2022 Coturex - F5RQG
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Publisher of the status message of the regulation (TOPIC_STATUS).
+# - interval : at most one publication every 'interval' seconds, evaluate() does not even build the status in between
+# - delta : a full status every 'full_period' seconds ("full": true), and in between only the fields that changed
+#   since the previous publication, with "date" : {"date": ..., "grid": 120, "equipments": {"ecs": {"current_power": 800}}}
+#   (the equipments are keyed by name). The diagnostic blocks (date_str, scheduler, response, domoticz, filters,
+#   prediction, pairing) are cumulative or derived, they are only sent in the full status. Nothing is published while
+#   nothing changed.
+# - compact : JSON without spaces
+
+import json, time
+
+import metrics
+
+# fields of the full status only
+SNAPSHOT_ONLY = ('date', 'date_str', 'scheduler', 'response', 'domoticz', 'filters', 'prediction',
+                 'pairing')
+
+
+class StatusPublisher:
+    def __init__(self, topic, interval=0, full_period=60, delta=False, compact=False):
+        self.topic = topic
+        self.interval = interval
+        self.full_period = full_period
+        self.delta = delta
+        self.separators = (',', ':') if compact else None
+        self.last_sent = None
+        self.last_full = None
+        self.fields = None      # fields of the last published status
+        self.published = 0
+        self.unchanged = 0
+
+    def due(self, t):
+        """ True if a status may be published at t"""
+        return self.last_sent is None or t - self.last_sent >= self.interval
+
+    def publish(self, client, status, t):
+        """ Publish the status (or its changes), return False if nothing was sent"""
+        fields = flatten(status)
+        if self.delta and self.last_full is not None and t - self.last_full < self.full_period:
+            msg = diff(self.fields, fields)
+            if msg is None:
+                self.unchanged += 1
+                return False
+            msg['date'] = status['date']
+        else:
+            msg = status
+            if self.delta:
+                msg = dict(status, full=True)
+                self.last_full = t
+        self.fields = fields
+        stage = time.perf_counter()
+        payload = json.dumps(msg, separators=self.separators)
+        metrics.observe('encode', stage)
+        stage = time.perf_counter()
+        client.publish(self.topic, payload)
+        metrics.observe('publish', stage)
+        self.last_sent = t
+        self.published += 1
+        return True
+
+
+def flatten(status):
+    """ Comparable fields of a status : {key: value}, the equipments as {name: {key: value}}"""
+    fields = {k: v for k, v in status.items() if k not in SNAPSHOT_ONLY and k != 'equipments'}
+    fields['equipments'] = {e['name']: e for e in status.get('equipments', ())}
+    return fields
+
+def diff(old, new):
+    """ Fields of new that differ from old, None if there is no change"""
+    msg = {k: v for k, v in new.items() if k != 'equipments' and old.get(k) != v}
+    equipments = {}
+    old_equipments = old['equipments']
+    for name, e in new['equipments'].items():
+        previous = old_equipments.get(name)
+        if previous is None:
+            equipments[name] = e
+            continue
+        changed = {k: v for k, v in e.items() if previous.get(k) != v}
+        if changed:
+            equipments[name] = changed
+    if equipments:
+        msg['equipments'] = equipments
+    return msg or None
@@ -0,0 +1,112 @@
+#!/usr/bin/python3
+
+# Copyright (C) 2020-2022 Coturex - F5RQG
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Parameter sweep: the recorded days are replayed (see replay.py, closed loop) for every combination of margin,
+# balance_threshold, period and counter_limit, the runs are spread over the cores with a process pool. The settings
+# are ranked by grid import, then injection, then command count (relays + variators), summed over the recordings.
+# The other settings are the ones of config.ini (current directory).
+#
+# $> python3 sweep.py trace.bin [day2.jsonl ...] [--margin 0,20,50] [--threshold 10,20,40] [--period 2.5,5]
+#                     [--counter 3,5,8] [--cloud 50] [--workers 4] [--top 10] [--csv sweep.csv]
+
+import argparse, csv, itertools, logging, os, sys, time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import replay
+
+PARAMETERS = ('margin', 'threshold', 'period', 'counter')
+SORT_KEYS = ('grid', 'injection', 'commands')
+
+
+def init_worker():
+    logging.getLogger('regulation_log').disabled = True
+    logging.getLogger('regulation_debug').disabled = True
+
+def run_job(params, path, cloud):
+    """ Replay one recording with one setting, return the totals of the report"""
+    margin, threshold, period, counter = params
+
+    def setup(regulation):
+        regulation.MARGIN = margin
+        regulation.BALANCE_THRESHOLD = threshold
+        regulation.set_evaluation_period(period)
+        regulation.step_response.band = threshold
+        regulation.equipment.COUNTER_LIMIT = counter
+
+    report = replay.run(replay.read_recording(path), cloud, setup=setup)
+    totals = {'grid': 0, 'injection': 0, 'production': 0, 'variator': 0, 'relay': 0}
+    if report is not None:
+        for k in ('grid', 'injection', 'production'):
+            totals[k] = report['energy'][k]
+        for e in report['equipments'].values():
+            totals['variator' if e['type'] == 'variable' else 'relay'] += e['commands']
+    return params, totals
+
+def values(cast):
+    return lambda s: [cast(v) for v in s.split(',')]
+
+def main():
+    parser = argparse.ArgumentParser(description="rank regulation settings over recorded days")
+    parser.add_argument('recordings', nargs='+', help="trace files or JSON lines recordings")
+    parser.add_argument('--margin', type=values(int), default=[0, 20, 50], help="watts, comma separated")
+    parser.add_argument('--threshold', type=values(int), default=[10, 20, 40], help="balance threshold, watts")
+    parser.add_argument('--period', type=values(float), default=[2.5, 5], help="evaluation period, seconds")
+    parser.add_argument('--counter', type=values(int), default=[3, 5, 8], help="check_over counter limit")
+    parser.add_argument('--cloud', type=int, default=50, help="cloud forecast (percent) given to the fallback")
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--sort', default=','.join(SORT_KEYS), help="ranking keys, among " + ', '.join(SORT_KEYS))
+    parser.add_argument('--top', type=int, default=10, help="number of settings printed")
+    parser.add_argument('--csv', help="write every setting to this CSV file")
+    args = parser.parse_args()
+    keys = args.sort.split(',')
+    if any(k not in SORT_KEYS for k in keys):
+        parser.error("--sort keys are " + ', '.join(SORT_KEYS))
+
+    grid = list(itertools.product(args.margin, args.threshold, args.period, args.counter))
+    jobs = [(params, path) for params in grid for path in args.recordings]
+    results = {params: {'grid': 0, 'injection': 0, 'production': 0, 'variator': 0, 'relay': 0} for params in grid}
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=init_worker) as pool:
+        futures = [pool.submit(run_job, params, path, args.cloud) for params, path in jobs]
+        for done, future in enumerate(as_completed(futures), 1):
+            params, totals = future.result()
+            for k, v in totals.items():
+                results[params][k] += v
+            print("\r{}/{} runs".format(done, len(jobs)), end='', file=sys.stderr, flush=True)
+    print(" in {:.1f}s ({} workers)".format(time.perf_counter() - start, args.workers), file=sys.stderr)
+
+    def rank_key(params):
+        r = results[params]
+        r = dict(r, commands=r['variator'] + r['relay'])
+        return tuple(round(r[k]) for k in keys)
+    ranking = sorted(grid, key=rank_key)
+
+    print("{:>4} {:>6} {:>9} {:>6} {:>7} {:>10} {:>10} {:>9} {:>6}".format(
+        'rank', 'margin', 'threshold', 'period', 'counter', 'grid Wh', 'inject Wh', 'variator', 'relay'))
+    for rank, params in enumerate(ranking[:args.top], 1):
+        r = results[params]
+        print("{:>4} {:>6} {:>9} {:>6} {:>7} {:>10.0f} {:>10.0f} {:>9} {:>6}".format(
+            rank, *params, r['grid'], r['injection'], r['variator'], r['relay']))
+    if args.csv:
+        with open(args.csv, 'w', newline='') as f:
+            writer = csv.writer(f, delimiter=';')
+            writer.writerow(('rank',) + PARAMETERS + ('grid', 'injection', 'production', 'variator', 'relay'))
+            for rank, params in enumerate(ranking, 1):
+                r = results[params]
+                energies = [round(r[k], 1) for k in ('grid', 'injection', 'production')]
+                writer.writerow([rank, *params, *energies, r['variator'], r['relay']])
+
+if __name__ == '__main__':
+    main()
@@ -1,2 +1,3 @@
 #!/usr/bin/sh
-scp pi@10.3.141.1:/home/pi/pv_router/status.ini .
+# status.ini is the last snapshot, the counters since then are in status.ini.journal : both are needed
+scp pi@10.3.141.1:/home/pi/pv_router/status.ini pi@10.3.141.1:/home/pi/pv_router/status.ini.journal .
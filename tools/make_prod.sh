@@ -5,5 +5,6 @@ mkdir prod
 cp *py prod
 mv prod/regulation.py prod/regulation_prod.py
 cp archives/$ts/*.ini prod
+cp archives/$ts/status.ini.journal prod 2>/dev/null
 cp archives/$ts/*.log prod
 cp calibration/power_calibration_ECS.csv prod
@@ -1,2 +1,7 @@
 #!/usr/bin/sh
-scp status.ini pi@10.3.141.1:/home/pi/pv_router
+# status.ini goes with its journal, a status.ini alone must not keep the journal of the remote one
+if [ -f status.ini.journal ]; then
+    scp status.ini status.ini.journal pi@10.3.141.1:/home/pi/pv_router
+else
+    scp status.ini pi@10.3.141.1:/home/pi/pv_router && ssh pi@10.3.141.1 rm -f /home/pi/pv_router/status.ini.journal
+fi